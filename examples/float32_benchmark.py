@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# Copyright 2016 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# float32_benchmark.py
+#
+# Tracks an atlas-aligned DWI volume in float64 and in float32 and compares
+# the run time, peak memory and resulting graphs of the two.
+
+from __future__ import print_function
+
+from argparse import ArgumentParser
+from multiprocessing import Process, Queue
+import resource
+import time
+import numpy as np
+import ndmg.utils as mgu
+from ndmg.track.track import track
+from ndmg.graph.graph import make_graphs
+
+
+def run(queue, dwi, mask, gtab, labels, dtype, n_jobs):
+    """
+    Tracks and builds the graphs of dwi, putting the adjacency matrices, the
+    run time and the peak resident memory, in MB, of this process and of the
+    largest of its worker processes on the queue. Each run is made in its
+    own process, as the peak resident memory of a process never decreases.
+    """
+    start = time.time()
+    tens, tracks = track().eudx_basic(dwi, mask, gtab, stop_val=0.2,
+                                      n_jobs=n_jobs, dtype=dtype)
+    graphs = make_graphs(tracks, labels, backend='sparse', n_jobs=n_jobs)
+    elapsed = time.time() - start
+    # ru_maxrss is in kB on Linux
+    peak = [resource.getrusage(who).ru_maxrss / 1024.0
+            for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    queue.put(([g.get_adjacency() for g in graphs], len(tracks), elapsed,
+               peak))
+
+
+def main():
+    parser = ArgumentParser(description="Compares tracking in float64 and \
+                            float32")
+    parser.add_argument("dwi", action="store", help="Atlas-aligned DWI")
+    parser.add_argument("bval", action="store", help="DTI scanner b-values")
+    parser.add_argument("bvec", action="store", help="DTI scanner b-vectors")
+    parser.add_argument("mask", action="store", help="Nifti brain mask")
+    parser.add_argument("labels", action="store", nargs="+", help="Nifti \
+                        labels of regions of interest in atlas space")
+    parser.add_argument("-n", "--n_jobs", type=int, default=1,
+                        help="Number of processes to use")
+    result = parser.parse_args()
+
+    gtab = mgu.load_bval_bvec(result.bval, result.bvec)
+    runs = {}
+    for dtype in (np.float64, np.float32):
+        queue = Queue()
+        proc = Process(target=run, args=(queue, result.dwi, result.mask,
+                                         gtab, result.labels, dtype,
+                                         result.n_jobs))
+        proc.start()
+        runs[dtype] = queue.get()
+        proc.join()
+        print("{}: {} fibers in {:.1f}s, peak {:.0f} MB (workers {:.0f} MB)"
+              .format(np.dtype(dtype).name, runs[dtype][1], runs[dtype][2],
+                      runs[dtype][3][0], runs[dtype][3][1]))
+
+    for label, a64, a32 in zip(result.labels, runs[np.float64][0],
+                               runs[np.float32][0]):
+        diff = abs(a64 - a32)
+        total = max(a64.sum(), 1)
+        print("{}: {} of {} edges differ, {:.4%} of fiber count".format(
+            mgu.get_filename(label), diff.nnz, a64.nnz, diff.sum() / total))
+
+
+if __name__ == "__main__":
+    main()
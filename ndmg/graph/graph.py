@@ -21,40 +21,60 @@
 
 from __future__ import print_function
 
-from itertools import combinations
 from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool
 import numpy as np
 import networkx as nx
-import nibabel as nb
+from scipy import sparse
 import ndmg
+from ndmg.utils.utils import load_atlas_index
+from ndmg.track.fibers import fiber_array
+import json
+import os.path as op
+import shutil
+import tempfile
 import time
 
 
+# Edge attributes which can be computed alongside the fiber count
+EDGE_ATTRS = ('mean_length', 'inv_length', 'vol_norm')
+
+
 class graph(object):
-    def __init__(self, N, rois, attr=None, sens="dwi"):
+    def __init__(self, N, rois, attr=None, sens="dwi", backend="networkx"):
         """
         Initializes the graph with nodes corresponding to the number of ROIs
 
         **Positional Arguments:**
 
                 N:
-                    - Number of rois
+                    - Number of rois. If None, it is counted from rois.
                 rois:
-                    - Set of ROIs as either an array or niftii file)
+                    - Set of ROIs as a niftii file
                 attr:
                     - Node or graph attributes. Can be a list. If 1 dimensional
                       will be interpretted as a graph attribute. If N
                       dimensional will be interpretted as node attributes. If
                       it is any other dimensional, it will be ignored.
+                backend:
+                    - 'networkx' builds the graph as edges are added. 'sparse'
+                      accumulates edges into a scipy.sparse adjacency matrix
+                      and only builds a networkx graph when get_graph is
+                      called, which is much lighter for large parcellations.
         """
-        self.N = N
+        if backend not in ('networkx', 'sparse'):
+            raise ValueError('networkx and sparse backends currently supported')
+        self.backend = backend
         self.edge_dict = defaultdict(int)
 
-        self.rois = nb.load(rois).get_data()
-        n_ids = np.unique(self.rois)
-        n_ids = n_ids[n_ids != 0]
+        # Label volume and sorted label table come from the atlas index
+        index = load_atlas_index(rois)
+        self.rois = index['labels']
+        n_ids = self.n_ids = index['ids']
+        self.N = N if N is not None else len(n_ids)
 
-        self.g = nx.Graph(name="Generated by NeuroData's MRI Graphs (ndmg)",
+        self.attrs = dict(name="Generated by NeuroData's MRI Graphs (ndmg)",
                           date=time.asctime(time.localtime()),
                           source="http://m2g.io",
                           region="brain",
@@ -62,50 +82,113 @@ class graph(object):
                           ecount=0,
                           vcount=len(n_ids)
                           )
-        print(self.g.graph)
+        print(self.attrs)
+
+        self.volumes = index['counts']
+        self.voxel_size = np.sqrt((index['affine'][:3, :3] ** 2).sum(0))
 
-        [self.g.add_node(ids) for ids in n_ids]
+        self.adj = sparse.csr_matrix((len(n_ids), len(n_ids)), dtype=np.int32)
+        self.sums = {}
+        self.edge_attrs = []
+        self.g = None
+        if self.backend == 'networkx':
+            self.g = self._new_graph()
         pass
 
-    def make_graph(self, streamlines, attr=None):
+    def _new_graph(self):
+        """
+        Creates a networkx graph holding the nodes and graph attributes
+        """
+        g = nx.Graph(**self.attrs)
+        g.add_nodes_from(self.n_ids.tolist())
+        return g
+
+    def make_graph(self, streamlines, attr=None, n_jobs=1, batch_size=50000,
+                   edge_attrs=(), endpoints=None):
         """
         Takes streamlines and produces a graph
 
         **Positional Arguments:**
 
                 streamlines:
-                    - Fiber streamlines either file or array in a dipy EuDX
-                      or compatible format.
-        """
-        nlines = np.shape(streamlines)[0]
-        print("# of Streamlines: " + str(nlines))
-
-        for idx, streamline in enumerate(streamlines):
-            if (idx % int(nlines*0.05)) == 0:
-                print(idx)
-
-            points = np.round(streamline).astype(int)
-            p = set()
-            for point in points:
-                try:
-                    loc = self.rois[point[0], point[1], point[2]]
-                except IndexError:
-                    pass
-                else:
-                    pass
-
-                if loc:
-                    p.add(loc)
-
-            edges = combinations(p, 2)
-            for edge in edges:
-                lst = tuple([int(node) for node in edge])
-                self.edge_dict[tuple(sorted(lst))] += 1
+                    - Fiber streamlines either file, fiber_array or list in
+                      a dipy EuDX or compatible format. An iterator or
+                      generator of streamlines is consumed incrementally.
+
+        **Optional Arguments:**
+
+                n_jobs:
+                    - Number of processes to split the streamlines across
+                batch_size:
+                    - Number of streamlines processed at a time
+                edge_attrs:
+                    - Edge attributes to compute alongside the fiber count,
+                      in the same pass over the streamlines. Any of
+                      'mean_length' (mean length of the edge's fibers, in
+                      mm), 'inv_length' (sum of the inverse fiber lengths)
+                      and 'vol_norm' (count divided by the mean volume of
+                      the two ROIs, in voxels).
+                endpoints:
+                    - If given, only the first and last endpoints points of
+                      each fiber are looked up, and the fiber connects the
+                      ROIs nearest to its two ends. Otherwise every ROI a
+                      fiber passes through is connected to every other.
+        """
+        lengths = check_edge_attrs(edge_attrs)
+        edges = streamline_edges(streamlines, self.rois, n_jobs=n_jobs,
+                                 batch_size=batch_size, lengths=lengths,
+                                 voxel_size=self.voxel_size,
+                                 endpoints=endpoints)
+        self._add_edges(*edges[0], edge_attrs=edge_attrs)
+
+    def _add_edges(self, src, dst, weight, edge_attrs=()):
+        """
+        Adds weighted edges, given as parallel arrays of node labels, to the
+        graph. Weights of edges which already exist are summed. If weight is
+        2 dimensional its columns are the fiber count, summed fiber length
+        and summed inverse fiber length of each edge (see streamline_edges).
+        """
+        self.edge_attrs += [a for a in edge_attrs if a not in self.edge_attrs]
+        i = np.searchsorted(self.n_ids, np.minimum(src, dst))
+        j = np.searchsorted(self.n_ids, np.maximum(src, dst))
+        shape = self.adj.shape
+        if weight.ndim == 2:
+            for name, col in (('length', 1), ('inv_length', 2)):
+                total = sparse.coo_matrix((weight[:, col], (i, j)), shape=shape)
+                total = total.tocsr()
+                if name in self.sums:
+                    total = total + self.sums[name]
+                self.sums[name] = total
+            # Summed as floats with the lengths, but counts are integers
+            weight = weight[:, 0].astype(np.int32)
+        if weight.dtype.kind in 'iub':
+            weight = weight.astype(np.int32)
+        self.adj = self.adj + sparse.coo_matrix((weight, (i, j)),
+                                                shape=shape).tocsr()
+
+        if self.backend == 'sparse':
+            self.g = None
+            return
+
+        for edge in zip(src.tolist(), dst.tolist(), weight.tolist()):
+            self.edge_dict[edge[:2]] += edge[2]
 
         edge_list = [(k[0], k[1], v) for k, v in self.edge_dict.items()]
         self.g.add_weighted_edges_from(edge_list)
+        self._set_edge_attrs(self.g)
 
-    def cor_graph(self, timeseries, attr=None):
+    def _set_edge_attrs(self, g):
+        """
+        Stores the requested edge attributes on the edges of a networkx graph
+        """
+        for attr in self.edge_attrs:
+            adj = self.get_adjacency(attr).tocoo()
+            for u, v, val in zip(self.n_ids[adj.row].tolist(),
+                                 self.n_ids[adj.col].tolist(),
+                                 adj.data.tolist()):
+                g[u][v][attr] = val
+
+    def cor_graph(self, timeseries, attr=None, thresh=None, dtype=np.float64):
         """
         Takes timeseries and produces a correlation matrix
 
@@ -113,33 +196,82 @@ class graph(object):
             timeseries:
                 -the timeseries file to extract correlation for.
                           dimensions are [numrois]x[numtimesteps]
+
+        **Optional Arguments:**
+            thresh:
+                - Absolute correlations below this value are not added as
+                  edges, to sparsify the graph.
+            dtype:
+                - Float type used for the computation. np.float32 halves the
+                  memory needed for the timeseries and correlation matrix.
+
+        **Returns:**
+            cor:
+                - The [numrois]x[numrois] absolute correlation matrix, so
+                  callers who only need the matrix can skip networkx by
+                  using the sparse backend.
         """
         print("Estimating correlation matrix for {} ROIs...".format(self.N))
-        cor = np.corrcoef(timeseries)  # calculate pearson correlation
-
-        roilist = np.unique(self.rois)
-        roilist = roilist[roilist != 0]
-        roilist = np.sort(roilist)
-
-        for (idx_out, roi_out) in enumerate(roilist):
-            for (idx_in, roi_in) in enumerate(roilist):
-                self.edge_dict[tuple((roi_out, roi_in))] = float(np.absolute(
-                    cor[idx_out, idx_in]))
-
-        edge_list = [(k[0], k[1], v) for k, v in self.edge_dict.items()]
-
-        self.g.add_weighted_edges_from(edge_list)
-        pass
+        ts = np.asarray(timeseries, dtype=dtype)
+        ts = ts - ts.mean(axis=1)[:, np.newaxis]
+        norm = np.sqrt((ts ** 2).sum(axis=1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # calculate absolute pearson correlation
+            cor = np.absolute(ts.dot(ts.T) / np.outer(norm, norm))
+
+        # Upper triangle (with the diagonal) as every pair of ROIs
+        idx_out, idx_in = np.triu_indices(len(cor))
+        weight = cor[idx_out, idx_in]
+        if thresh is not None:
+            keep = weight >= thresh
+            idx_out, idx_in, weight = idx_out[keep], idx_in[keep], weight[keep]
+
+        roilist = self.n_ids
+        self._add_edges(roilist[idx_out], roilist[idx_in], weight)
+        return cor
 
     def get_graph(self):
         """
-        Returns the graph object created
+        Returns the graph object created. With the sparse backend the networkx
+        graph is built from the adjacency matrix on the first call.
         """
-        try:
-            return self.g
-        except AttributeError:
-            print("Error: the graph has not yet been defined.")
-            pass
+        if self.g is None:
+            self.g = self._new_graph()
+            adj = self.adj.tocoo()
+            self.g.add_weighted_edges_from(zip(self.n_ids[adj.row].tolist(),
+                                               self.n_ids[adj.col].tolist(),
+                                               adj.data.tolist()))
+            self._set_edge_attrs(self.g)
+        return self.g
+
+    def get_adjacency(self, attr='count'):
+        """
+        Returns the upper triangular adjacency matrix of the graph as a
+        scipy.sparse CSR matrix, with rows and columns ordered as the sorted
+        node labels.
+
+        **Optional Arguments:**
+
+                attr:
+                    - Edge attribute held by the matrix: 'count', or one of
+                      the edge_attrs computed by make_graph.
+        """
+        if attr == 'count':
+            return self.adj
+        adj = self.adj.tocoo()
+        if attr == 'vol_norm':
+            vol = self.volumes.astype(np.float64)
+            val = 2.0 * adj.data / (vol[adj.row] + vol[adj.col])
+        else:
+            total = {'mean_length': 'length'}.get(attr, attr)
+            if total not in self.sums:
+                raise ValueError('{} has not been computed'.format(attr))
+            val = np.zeros(adj.nnz)
+            if adj.nnz:
+                val = np.asarray(self.sums[total][adj.row, adj.col]).ravel()
+            if attr == 'mean_length':
+                val = val / adj.data
+        return sparse.csr_matrix((val, (adj.row, adj.col)), shape=adj.shape)
 
     def save_graph(self, graphname, fmt='edgelist'):
         """
@@ -153,8 +285,24 @@ class graph(object):
         **Optional Arguments:**
 
                 fmt:
-                    - Output graph format
+                    - Output graph format: 'edgelist', 'gpickle', 'graphml',
+                      or 'npz', a compressed binary format holding the CSR
+                      adjacency (see ndmg.utils.loadGraphs)
         """
+        if fmt == 'npz':
+            self._save_npz(graphname)
+            return
+
+        if self.backend == 'sparse' and fmt == 'edgelist':
+            # Nodes are renumbered from 1 in sorted label order, as below
+            adj = self.adj.tocoo()
+            with open(graphname, 'w') as f:
+                for edge in zip((adj.row + 1).tolist(), (adj.col + 1).tolist(),
+                                adj.data.tolist()):
+                    f.write("{} {} {}\n".format(*edge))
+            return
+
+        self.get_graph()
         self.g.graph['ecount'] = nx.number_of_edges(self.g)
         g = nx.convert_node_labels_to_integers(self.g, first_label=1)
         if fmt == 'edgelist':
@@ -164,13 +312,509 @@ class graph(object):
         elif fmt == 'graphml':
             nx.write_graphml(g, graphname)
         else:
-            raise ValueError('edgelist, gpickle, and graphml currently supported')
+            raise ValueError('edgelist, gpickle, graphml, and npz currently '
+                             'supported')
         pass
 
+    def _save_npz(self, graphname):
+        """
+        Writes the upper triangular CSR adjacency straight to a compressed
+        .npz file, along with the node labels, graph attributes, and one
+        array per edge attribute aligned with the adjacency data. Nodes are
+        numbered from 1 in sorted label order, as in the other formats.
+        """
+        adj = self.adj.tocsr()
+        adj.sort_indices()
+        self.attrs['ecount'] = adj.nnz
+        row = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+        edge_attrs = {}
+        for attr in self.edge_attrs:
+            val = np.zeros(adj.nnz)
+            if adj.nnz:
+                val = np.asarray(self.get_adjacency(attr)[row, adj.indices]
+                                 ).ravel()
+            edge_attrs['attr_' + attr] = val
+        np.savez_compressed(graphname, indptr=adj.indptr, indices=adj.indices,
+                            data=adj.data, nodes=self.n_ids,
+                            attrs=json.dumps(self.attrs), **edge_attrs)
+
     def summary(self):
         """
         User friendly wrapping and display of graph properties
         """
         print("\n Graph Summary:")
+        if self.g is None:
+            nodes = len(self.n_ids)
+            edges = self.adj.nnz
+            print("Name: {}".format(self.attrs['name']))
+            print("Type: Graph")
+            print("Number of nodes: {}".format(nodes))
+            print("Number of edges: {}".format(edges))
+            print("Average degree: {:.4f}".format(2.0 * edges / max(nodes, 1)))
+            return
         print(nx.info(self.g))
         pass
+
+
+def make_graphs(streamlines, rois, attr=None, sens="dwi", backend="networkx",
+                n_jobs=1, batch_size=50000, edge_attrs=(), endpoints=None):
+    """
+    Produces a graph for each of several parcellations with a single pass
+    over the streamlines. The label volumes are stacked into one
+    (n_atlases, X, Y, Z) lookup so every point is rounded and gathered once
+    for all parcellations. Labels are read from the atlas index, so the stack
+    is uint16 unless a parcellation needs uint32.
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Fiber streamlines in a dipy EuDX or compatible format, an
+                  iterator of streamlines, or the path to a fibers file.
+            rois:
+                - List of label volumes as nifti files, all in the same space
+
+    **Optional Arguments:**
+
+            sens:
+                - Sensor type recorded in the graph attributes
+            backend:
+                - Graph backend, 'networkx' or 'sparse' (see graph)
+            n_jobs:
+                - Number of processes to split the streamlines across
+            batch_size:
+                - Number of streamlines processed at a time
+            edge_attrs:
+                - Edge attributes to compute alongside the fiber count (see
+                  graph.make_graph)
+            endpoints:
+                - Number of points at each end of a fiber used to find the
+                  ROIs it connects. By default all points are used.
+
+    **Returns:**
+
+            graphs:
+                - List of graph objects, in the same order as rois
+    """
+    graphs = [graph(None, roi, attr=attr, sens=sens, backend=backend)
+              for roi in rois]
+    lut = np.stack([g.rois for g in graphs])
+
+    lengths = check_edge_attrs(edge_attrs)
+    edges = streamline_edges(streamlines, lut, n_jobs=n_jobs,
+                             batch_size=batch_size, lengths=lengths,
+                             voxel_size=graphs[0].voxel_size,
+                             endpoints=endpoints)
+    for g, edge in zip(graphs, edges):
+        g._add_edges(*edge, edge_attrs=edge_attrs)
+    return graphs
+
+
+def check_edge_attrs(edge_attrs):
+    """
+    Validates a list of edge attributes, and returns whether computing them
+    requires fiber lengths.
+    """
+    for attr in edge_attrs:
+        if attr not in EDGE_ATTRS:
+            raise ValueError('Edge attributes must be among: ' +
+                             ', '.join(EDGE_ATTRS))
+    return any(attr in ('mean_length', 'inv_length') for attr in edge_attrs)
+
+
+def streamline_edges(streamlines, rois, n_jobs=1, batch_size=50000,
+                     lengths=False, voxel_size=None, endpoints=None):
+    """
+    Computes the ROI-to-ROI edges, and the number of fibers supporting each,
+    for one or several label volumes. Streamlines are consumed in batches of
+    at most batch_size and the edge counts reduced after each, so memory use
+    is bounded by the batch size and the number of edges rather than the
+    number of streamlines. With n_jobs > 1 the batches are handled by a pool
+    of processes; the label volume is written once to a .npy file which the
+    workers memory-map, rather than pickling it to each of them.
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Fiber streamlines as a fiber_array or list, an iterator or
+                  generator of streamlines, or the path to a fibers file.
+            rois:
+                - 3D label volume, or a (n_atlases, X, Y, Z) stack of them
+
+    **Optional Arguments:**
+
+            n_jobs:
+                - Number of processes to use
+            batch_size:
+                - Maximum number of streamlines held in memory per process
+            lengths:
+                - Whether to also sum the fiber lengths of each edge
+            voxel_size:
+                - Voxel dimensions used to convert lengths to mm
+            endpoints:
+                - Number of points at each end of a fiber to look up, in
+                  which case each fiber gives at most one edge: between the
+                  labelled voxels nearest to its two ends.
+
+    **Returns:**
+
+            edges:
+                - List with a (src, dst, count) tuple of arrays per volume.
+                  If lengths is set, count is instead an (E, 3) array
+                  holding the count, summed length and summed inverse
+                  length of each edge.
+    """
+    lut = rois if rois.ndim == 4 else rois[np.newaxis]
+    batches = iter_batches(streamlines, batch_size)
+    if n_jobs <= 1:
+        opts = (lengths, voxel_size, endpoints)
+        parts = ((_lut_edges(batch, lut, *opts), len(batch))
+                 for batch in batches)
+        return _reduce_edges(parts, len(lut), lengths)
+
+    # Volumes from an atlas index are already memory-mappable .npy files
+    tmpdir = tempfile.mkdtemp(prefix='ndmg_graph_')
+    lut_file = getattr(rois, 'filename', None)
+    if lut_file is None:
+        lut_file = op.join(tmpdir, 'labels.npy')
+        np.save(lut_file, lut)
+
+    pool = Pool(n_jobs)
+    try:
+        opts = (lengths, voxel_size, endpoints)
+        parts = _pool_edges(pool, batches, lut_file, opts, n_jobs)
+        return _reduce_edges(parts, len(lut), lengths)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmpdir)
+
+
+def _pool_edges(pool, batches, lut_file, opts, n_jobs):
+    """
+    Maps batches of streamlines onto a pool, reading only a couple of batches
+    per worker ahead at a time. Yields the edges of each batch and its size.
+    """
+    while True:
+        window = list(islice(batches, 2 * n_jobs))
+        if not window:
+            return
+        chunks = [(batch, lut_file) + opts for batch in window]
+        for part, batch in zip(pool.imap(_chunk_edges, chunks), window):
+            yield part, len(batch)
+
+
+def _reduce_edges(parts, n_vols, lengths=False):
+    """
+    Sums the edge counts of each batch into a running total per volume. If
+    lengths is set, the weights of the edges are (E, 3) arrays (see
+    streamline_edges), even when there are no streamlines.
+    """
+    edges = [None] * n_vols
+    nlines = 0
+    for part, nfibs in parts:
+        nlines += nfibs
+        for idx, edge in enumerate(part):
+            if edges[idx] is not None:
+                edge = (np.concatenate(x) for x in zip(edges[idx], edge))
+                edge = count_edges(*edge)
+            edges[idx] = edge
+    if not nlines:
+        empty = np.zeros(0, dtype=np.int64)
+        weight = np.zeros((0, 3)) if lengths else empty
+        edges = [(empty, empty, weight)] * n_vols
+    print("# of Streamlines: " + str(nlines))
+    return edges
+
+
+def iter_batches(streamlines, batch_size):
+    """
+    Splits streamlines into fiber_arrays, or lists, of at most batch_size
+    streamlines.
+
+    **Positional Arguments:**
+
+            streamlines:
+                - Fiber streamlines as a fiber_array or list, an iterator or
+                  generator of streamlines, or the path to a fibers file.
+                  A .npy fibers file is memory-mapped and read a batch at a
+                  time.
+            batch_size:
+                - Maximum number of streamlines per batch
+    """
+    if isinstance(streamlines, str):
+        streamlines = fiber_array.load(streamlines, mmap_mode='r')
+    if isinstance(streamlines, fiber_array):
+        for start in range(0, len(streamlines), batch_size):
+            yield streamlines[start:start + batch_size]
+        return
+    streamlines = iter(streamlines)
+    while True:
+        batch = list(islice(streamlines, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _chunk_edges(args):
+    """
+    Pool worker: computes the edges of a chunk of streamlines against a
+    memory-mapped label volume stack
+    """
+    streamlines, lut_file = args[:2]
+    lut = np.load(lut_file, mmap_mode='r')
+    lut = lut if lut.ndim == 4 else lut[np.newaxis]
+    return _lut_edges(streamlines, lut, *args[2:])
+
+
+def _lut_edges(streamlines, lut, lengths=False, voxel_size=None,
+               endpoints=None):
+    """
+    Computes the edges of a set of streamlines for each volume in lut
+    """
+    points, fiber_ids = streamline_points(streamlines)
+    if endpoints:
+        fibers, idx = endpoint_index(fiber_ids, len(streamlines), endpoints)
+        labels = roi_lookup(points[idx.ravel()], lut)
+        labels = labels.reshape((len(lut),) + idx.shape)
+        pairs = [endpoint_pairs(fibers, lab) for lab in labels]
+    else:
+        labels = roi_lookup(points, lut)
+        pairs = [roi_pairs(fiber_ids, lab, return_fibers=True)
+                 for lab in labels]
+    if not lengths:
+        return [count_edges(src, dst) for src, dst, fib in pairs]
+
+    flen = fiber_lengths(points, fiber_ids, len(streamlines), voxel_size)
+    inv = np.zeros(len(flen))
+    inv[flen > 0] = 1.0 / flen[flen > 0]
+    edges = []
+    for src, dst, fib in pairs:
+        values = np.column_stack([np.ones(len(src)), flen[fib], inv[fib]])
+        edges += [count_edges(src, dst, values)]
+    return edges
+
+
+def streamline_points(streamlines):
+    """
+    Concatenates a set of streamlines into a single array of points
+
+    **Positional Arguments:**
+
+            streamlines:
+                - fiber_array, or list of (n, 3) arrays, of fiber points in
+                  voxel coordinates
+
+    **Returns:**
+
+            points:
+                - (P, 3) array holding the points of every streamline
+            fiber_ids:
+                - (P,) array giving the index of the streamline each point
+                  belongs to
+    """
+    if isinstance(streamlines, fiber_array):
+        streamlines = streamlines.compact()
+        return streamlines.points, streamlines.fiber_ids()
+    lengths = np.array([len(s) for s in streamlines], dtype=np.intp)
+    if not lengths.sum():
+        return np.zeros((0, 3)), np.zeros(0, dtype=np.intp)
+    points = np.concatenate([np.asarray(s).reshape(-1, 3)
+                             for s in streamlines])
+    fiber_ids = np.repeat(np.arange(len(lengths)), lengths)
+    return points, fiber_ids
+
+
+def roi_lookup(points, rois):
+    """
+    Finds the label of the voxel containing each point with a single gather
+    into the label volume. Points falling outside of the volume are given
+    the background label, 0.
+
+    **Positional Arguments:**
+
+            points:
+                - (P, 3) array of points in voxel coordinates
+            rois:
+                - 3D array of integer region labels, or a stack of label
+                  volumes with shape (n_atlases, X, Y, Z)
+
+    **Returns:**
+
+            labels:
+                - (P,) array of labels, or (n_atlases, P) for a stack
+    """
+    vox = np.round(points).astype(np.intp)
+    shape = np.array(rois.shape[-3:])
+    inside = np.all((vox >= 0) & (vox < shape), axis=1)
+    labels = np.zeros(rois.shape[:-3] + (len(vox),), dtype=rois.dtype)
+    vox = vox[inside]
+    labels[..., inside] = rois[..., vox[:, 0], vox[:, 1], vox[:, 2]]
+    return labels
+
+
+def endpoint_index(fiber_ids, nfibers, n):
+    """
+    Finds the indices of the points at either end of each fiber
+
+    **Positional Arguments:**
+
+            fiber_ids:
+                - (P,) array of fiber indices for each point
+            nfibers:
+                - Number of fibers
+            n:
+                - Number of points to take from each end
+
+    **Returns:**
+
+            fibers:
+                - Indices of the fibers with at least one point
+            idx:
+                - (F, 2, n) array of point indices. idx[:, 0] runs from the
+                  first point inwards and idx[:, 1] from the last point
+                  inwards. Short fibers repeat their middle point.
+    """
+    lengths = np.bincount(fiber_ids, minlength=nfibers)
+    fibers = np.flatnonzero(lengths)
+    lengths = lengths[fibers][:, np.newaxis]
+    starts = np.cumsum(lengths) - lengths.ravel()
+    steps = np.minimum(np.arange(n), lengths - 1)
+    head = starts[:, np.newaxis] + steps
+    tail = starts[:, np.newaxis] + lengths - 1 - steps
+    return fibers, np.stack([head, tail], axis=1)
+
+
+def endpoint_pairs(fibers, labels):
+    """
+    Pairs the ROIs at the two ends of each fiber. Each end is assigned the
+    first nonzero label found moving inwards from its tip.
+
+    **Positional Arguments:**
+
+            fibers:
+                - (F,) array of fiber indices
+            labels:
+                - (F, 2, n) array of labels at the ends of each fiber, as
+                  indexed by endpoint_index
+
+    **Returns:**
+
+            src, dst, fibers:
+                - Arrays of ROI labels with src < dst, and the fiber giving
+                  rise to each pair
+    """
+    labels = labels.reshape(-1, labels.shape[-1]).astype(np.int64)
+    first = (labels != 0).argmax(axis=1)
+    ends = labels[np.arange(len(labels)), first].reshape(-1, 2)
+    keep = (ends[:, 0] != 0) & (ends[:, 1] != 0) & (ends[:, 0] != ends[:, 1])
+    ends = ends[keep]
+    return ends.min(axis=1), ends.max(axis=1), fibers[keep]
+
+
+def fiber_lengths(points, fiber_ids, nfibers, voxel_size=None):
+    """
+    Computes the length of each streamline from its concatenated points
+
+    **Positional Arguments:**
+
+            points:
+                - (P, 3) array of points in voxel coordinates
+            fiber_ids:
+                - (P,) array of fiber indices for each point
+            nfibers:
+                - Number of fibers
+
+    **Optional Arguments:**
+
+            voxel_size:
+                - Voxel dimensions, to give lengths in mm rather than voxels
+    """
+    seg = np.diff(points, axis=0)
+    if voxel_size is not None:
+        seg = seg * voxel_size
+    same = fiber_ids[1:] == fiber_ids[:-1]
+    return np.bincount(fiber_ids[1:][same],
+                       weights=np.sqrt((seg[same] ** 2).sum(1)),
+                       minlength=nfibers)
+
+
+def roi_pairs(fiber_ids, labels, return_fibers=False):
+    """
+    Given the label of each point and the fiber it belongs to, produces
+    every pair of distinct ROIs which share a fiber, once per fiber.
+
+    **Positional Arguments:**
+
+            fiber_ids:
+                - (P,) array of fiber indices for each point
+            labels:
+                - (P,) array of ROI labels for each point
+
+    **Optional Arguments:**
+
+            return_fibers:
+                - Whether to also return the fiber index of each pair
+
+    **Returns:**
+
+            src, dst:
+                - Arrays of ROI labels such that src < dst for every pair
+            fibers:
+                - Array of the fiber giving rise to each pair, if requested
+    """
+    keep = labels != 0
+    labels = labels[keep].astype(np.int64)
+    if not len(labels):
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, empty) if return_fibers else (empty, empty)
+    stride = labels.max() + 1
+    # Sorted, unique (fiber, label) pairs: the set of ROIs each fiber visits
+    visits = np.unique(fiber_ids[keep].astype(np.int64) * stride + labels)
+    fibers = visits // stride
+    rois = visits % stride
+
+    # Within each fiber, pair every ROI with each of the ROIs after it
+    starts = np.flatnonzero(np.r_[True, fibers[1:] != fibers[:-1]])
+    sizes = np.diff(np.r_[starts, len(fibers)])
+    n_after = np.repeat(starts + sizes, sizes) - np.arange(len(fibers)) - 1
+    src = np.repeat(np.arange(len(fibers)), n_after)
+    first = np.repeat(np.cumsum(n_after) - n_after, n_after)
+    dst = src + np.arange(len(src)) - first + 1
+    if return_fibers:
+        return rois[src], rois[dst], fibers[src]
+    return rois[src], rois[dst]
+
+
+def count_edges(src, dst, weight=None):
+    """
+    Collapses a list of (possibly repeated) edges into unique edges and the
+    number of times each occurred.
+
+    **Positional Arguments:**
+
+            src, dst:
+                - Arrays of node labels for the endpoints of each edge
+
+    **Optional Arguments:**
+
+            weight:
+                - Count carried by each edge, if other than 1. Used to
+                  combine partial edge counts. If 2 dimensional, each
+                  column is summed separately.
+    """
+    if not len(src):
+        if weight is None:
+            weight = np.zeros(0, dtype=np.int64)
+        return src, dst, weight
+    stride = max(src.max(), dst.max()) + 1
+    edges, inverse = np.unique(src * stride + dst, return_inverse=True)
+    inverse = inverse.ravel()
+    if weight is None:
+        counts = np.bincount(inverse)
+    elif weight.ndim == 1:
+        counts = np.bincount(inverse, weights=weight).astype(weight.dtype)
+    else:
+        counts = np.column_stack([np.bincount(inverse, weights=w,
+                                              minlength=len(edges))
+                                  for w in weight.T]).astype(weight.dtype)
+    return edges // stride, edges % stride, counts
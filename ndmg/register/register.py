@@ -20,8 +20,20 @@
 # Email: gkiar@jhu.edu
 
 from subprocess import Popen, PIPE
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from glob import glob
+import sys
+import threading
+from scipy.ndimage import affine_transform
+import os
 import os.path as op
+import json
+import shutil
+import tempfile
+import hashlib
 import ndmg.utils as mgu
+from ndmg.utils.utils import file_hash
 import nibabel as nb
 import numpy as np
 import nilearn.image as nl
@@ -29,14 +41,86 @@ import nilearn.image as nl
 
 class register(object):
 
-    def __init__(self):
+    def __init__(self, cache_dir=None):
         """
         Enables registration of single images to one another as well as volumes
         within multi-volume image stacks. Has options to compute transforms,
         apply transforms, as well as a built-in method for aligning low
         resolution dwi images to a high resolution atlas.
+
+        **Optional Arguments:**
+
+                cache_dir:
+                    - Directory of a cache of the outputs of brain
+                      extraction and of linear, EPI and nonlinear alignment,
+                      keyed by the contents of their inputs and their
+                      parameters. Sessions sharing an anatomical image, and
+                      reruns, then reuse the transforms. By default nothing
+                      is cached.
         """
-        pass
+        self.cache_dir = cache_dir
+
+    def _cached(self, step, inputs, params, outputs, run):
+        """
+        Runs a registration step, or copies its outputs from the cache if
+        the step was run before on inputs with the same contents and the
+        same parameters.
+
+        **Positional Arguments:**
+
+                step:
+                    - Name of the step
+                inputs:
+                    - List of the input files of the step
+                params:
+                    - Dictionary of the parameters of the step
+                outputs:
+                    - Dictionary of the output files of the step, by role
+                run:
+                    - Function running the step
+        """
+        if self.cache_dir is None or not outputs:
+            return run()
+        roles = sorted(role + image_ext(out) for role, out in outputs.items())
+        key = xfm_cache_key(step, inputs, params, roles)
+        entry = op.join(self.cache_dir, key)
+        cached = [op.join(entry, role + image_ext(out))
+                  for role, out in outputs.items()]
+        if (op.isfile(op.join(entry, 'manifest.json')) and
+                all(op.isfile(f) for f in cached)):
+            print("Reusing cached {} outputs from {}".format(step, entry))
+            for f, out in zip(cached, outputs.values()):
+                shutil.copyfile(f, out)
+            return
+        run()
+
+        # Fill a temporary entry then rename it, so concurrent sessions
+        # never see a partial entry
+        tmp = None
+        try:
+            if not op.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp = tempfile.mkdtemp(dir=self.cache_dir)
+            for role, out in outputs.items():
+                shutil.copyfile(out, op.join(tmp, role + image_ext(out)))
+            with open(op.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump({'step': step, 'inputs': inputs, 'params': params,
+                           'outputs': outputs}, f)
+            os.rename(tmp, entry)
+        except (IOError, OSError) as e:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors=True)
+            if not op.isfile(op.join(entry, 'manifest.json')):
+                print("Could not cache {} outputs in {}: {}".format(
+                    step, self.cache_dir, e))
+
+    def extract_brain(self, inp, out, opts=""):
+        """
+        Extracts the brain from an image using FSL's BET (see
+        ndmg.utils.extract_brain), through the transform cache.
+        """
+        self._cached('bet', [inp], {'opts': opts}, {'out': out},
+                     lambda: mgu.extract_brain(inp, out, opts))
 
     def align(self, inp, ref, xfm=None, out=None, dof=12, searchrad=True,
               bins=256, interp=None, cost="mutualinfo"):
@@ -78,15 +162,27 @@ class register(object):
         if searchrad is not None:
             cmd += " -searchrx -180 180 -searchry -180 180 " +\
                    "-searchrz -180 180"
-        mgu.execute_cmd(cmd, verb=True)
+        outputs = {role: f for role, f in (('xfm', xfm), ('out', out))
+                   if f is not None}
+        params = {'dof': dof, 'searchrad': searchrad, 'bins': bins,
+                  'interp': interp, 'cost': cost}
+        if out is not None:
+            cmd = mgu.fsl_cmd(cmd, out)
+        self._cached('flirt', [inp, ref], params, outputs,
+                     lambda: mgu.execute_cmd(cmd, verb=True))
 
     def align_epi(self, epi, t1, brain, out):
         """
         Algins EPI images to T1w image
         """
         cmd = 'epi_reg --epi={} --t1={} --t1brain={} --out={}'
-        cmd = cmd.format(epi, t1, brain, out)
-        mgu.execute_cmd(cmd, verb=True)
+        cmd = mgu.fsl_cmd(cmd.format(epi, t1, brain, out), out)
+        # epi_reg names its outputs after out, without the extension
+        ext = image_ext(out)
+        base = out[:-len(ext)] if ext else out
+        outputs = {'out': base + (ext or fsl_ext()), 'xfm': base + '.mat'}
+        self._cached('epi_reg', [epi, t1, brain], {}, outputs,
+                     lambda: mgu.execute_cmd(cmd, verb=True))
 
     def align_nonlinear(self, inp, ref, xfm, warp, mask=None):
         """
@@ -111,11 +207,19 @@ class register(object):
         cmd = cmd.format(inp, xfm, warp, ref)
         if mask is not None:
             cmd += " --refmask={}".format(mask)
-        out, err = mgu.execute_cmd(cmd, verb=True)
+        cmd = mgu.fsl_cmd(cmd, warp)
+        inputs = [inp, ref, xfm] + ([mask] if mask is not None else [])
+        self._cached('fnirt', inputs, {'subsamp': '4,2,1,1'},
+                     {'warp': warp},
+                     lambda: mgu.execute_cmd(cmd, verb=True))
 
-    def applyxfm(self, inp, ref, xfm, aligned):
+    def applyxfm(self, inp, ref, xfm, aligned, interp='trilinear', n_jobs=1):
         """
-        Aligns two images with a given transform
+        Aligns two images with a given transform. Equivalent to flirt
+        -applyxfm, but the FSL transform is converted to a voxel to voxel
+        affine and applied in-process, volume by volume. The output is on
+        the voxel grid of ref, with its affine, so no further resampling to
+        ref is needed.
 
         **Positional Arguments:**
 
@@ -127,10 +231,22 @@ class register(object):
                     - Transform between two images
                 aligned:
                     - Aligned output image as a nifti image file
+
+        **Optional Arguments:**
+
+                interp:
+                    - Interpolation: 'trilinear', 'nearestneighbour' or
+                      'spline'
+                n_jobs:
+                    - Number of processes over which volumes are resampled
         """
-        cmd = "flirt -in {} -ref {} -out {} -init {} -interp trilinear -applyxfm"
-        cmd = cmd.format(inp, ref, aligned, xfm)
-        mgu.execute_cmd(cmd, verb=True)
+        inp_im = nb.load(inp)
+        ref_im = mgu.load_image(ref)
+        vox = fsl_to_voxel(np.loadtxt(xfm), inp_im, ref_im)
+        data = resample_volumes(inp_im.get_data(), vox, ref_im.shape[:3],
+                                INTERP_ORDER[interp], n_jobs,
+                                inp_im.get_data_dtype())
+        save_resampled(data, ref_im.get_affine(), inp_im, aligned)
 
     def apply_warp(self, inp, out, ref, warp, xfm=None, mask=None):
         """
@@ -158,11 +274,14 @@ class register(object):
             cmd += " --premat=" + xfm
         if mask is not None:
             cmd += " --mask=" + mask
-        mgu.execute_cmd(cmd, verb=True)
+        mgu.execute_cmd(mgu.fsl_cmd(cmd, out), verb=True)
 
-    def align_slices(self, dwi, corrected_dwi, idx):
+    def align_slices(self, dwi, corrected_dwi, idx, n_jobs=1):
         """
-        Performs eddy-correction (or self-alignment) of a stack of 3D images
+        Performs eddy-correction (or self-alignment) of a stack of 3D images.
+        As with FSL's eddy_correct, the stack is split into volumes, each
+        is registered to volume idx with flirt, and the results are merged,
+        but n_jobs of the registrations run at once.
 
         **Positional Arguments:**
                 dwi:
@@ -171,9 +290,31 @@ class register(object):
                     - Corrected and aligned DTI volume in a nifti file
                 idx:
                     - Index of the first B0 volume in the stack
+
+        **Optional Arguments:**
+                n_jobs:
+                    - Number of volumes registered concurrently
         """
-        cmd = "eddy_correct {} {} {}".format(dwi, corrected_dwi, idx)
-        status = mgu.execute_cmd(cmd, verb=True)
+        tmpdir = tempfile.mkdtemp(prefix='ndmg_eddy_',
+                                  dir=op.dirname(op.abspath(corrected_dwi)))
+        try:
+            # The split and registered volumes are written without gzip
+            mgu.execute_cmd("FSLOUTPUTTYPE=NIFTI fslsplit {} {} -t".format(
+                dwi, op.join(tmpdir, 'vol')), verb=True)
+            vols = sorted(glob(op.join(tmpdir, 'vol*')))
+            regs = [op.join(tmpdir, 'reg{:04d}.nii'.format(i))
+                    for i in range(len(vols))]
+            cmd = "flirt -in {} -ref {} -nosearch -interp trilinear " +\
+                  "-o {} -paddingsize 1"
+            cmds = [mgu.fsl_cmd(cmd.format(vol, vols[idx], reg), reg)
+                    for vol, reg in zip(vols, regs)]
+            print("Registering {} volumes to volume {}...".format(len(vols),
+                                                                 idx))
+            run_cmds(cmds, n_jobs)
+            cmd = "fslmerge -t {} {}".format(corrected_dwi, " ".join(regs))
+            mgu.execute_cmd(mgu.fsl_cmd(cmd, corrected_dwi), verb=True)
+        finally:
+            shutil.rmtree(tmpdir)
 
     def resample(self, base, ingested, template):
         """
@@ -189,12 +330,12 @@ class register(object):
                     - Image that is the target of the alignment
         """
         # Loads images
-        template_im = nb.load(template)
+        template_im = mgu.load_image(template)
         base_im = nb.load(base)
         # Aligns images
         target_im = nl.resample_img(base_im,
                                     target_affine=template_im.get_affine(),
-                                    target_shape=template_im.get_data().shape,
+                                    target_shape=template_im.shape,
                                     interpolation="nearest")
         # Saves new image
         nb.save(target_im, ingested)
@@ -212,9 +353,20 @@ class register(object):
                 - the template image to align to.
         """
         goal_res = int(nb.load(template).get_header().get_zooms()[0])
-        cmd = "flirt -in {} -ref {} -out {} -nosearch -applyisoxfm {}"
-        cmd = cmd.format(base, template, res, goal_res)
-        mgu.execute_cmd(cmd, verb=True)
+        # Equivalent to flirt -nosearch -applyisoxfm goal_res: the identity
+        # transform onto a grid of goal_res voxels spanning the template
+        base_im = nb.load(base)
+        temp_im = nb.load(template)
+        fov = np.array(temp_im.shape[:3]) * temp_im.get_header().get_zooms()[:3]
+        shape = tuple(int(n) for n in np.round(fov / goal_res))
+        grid = fsl_scaled_voxels(temp_im.get_affine(), shape, [goal_res] * 3)
+        affine = np.dot(temp_im.get_affine(),
+                        np.dot(np.linalg.inv(fsl_scaled_voxels(temp_im)),
+                               grid))
+        vox = np.dot(np.linalg.inv(fsl_scaled_voxels(base_im)), grid)
+        data = resample_volumes(base_im.get_data(), vox, shape,
+                                dtype=base_im.get_data_dtype())
+        save_resampled(data, affine, base_im, res)
 
     def combine_xfms(self, xfm1, xfm2, xfmout):
         """
@@ -233,7 +385,7 @@ class register(object):
         mgu.execute_cmd(cmd, verb=True)
 
     def func2atlas(self, func, t1w, atlas, atlas_brain, atlas_mask,
-                   aligned_func, aligned_t1w, outdir):
+                   aligned_func, aligned_t1w, outdir, n_jobs=1):
         """
         A function to change coordinates from the subject's
         brain space to that of a template using nonlinear
@@ -257,41 +409,56 @@ class register(object):
                 - the name of the aligned anatomical scan to produce
             outdir:
                 - the output base directory.
+            n_jobs:
+                - number of processes over which volumes are resampled.
        """
         func_name = mgu.get_filename(func)
         t1w_name = mgu.get_filename(t1w)
         atlas_name = mgu.get_filename(atlas)
 
-        func2 = mgu.name_tmps(outdir, func_name, "_t1w.nii.gz")
-        temp_aligned = mgu.name_tmps(outdir, func_name, "_noresamp.nii.gz")
-        t1w_brain = mgu.name_tmps(outdir, t1w_name, "_brain.nii.gz")
+        # Intermediate images are written uncompressed
+        func2 = mgu.name_tmps(outdir, func_name, "_t1w.nii")
+        temp_aligned = mgu.name_tmps(outdir, func_name, "_noresamp.nii")
+        t1w_brain = mgu.name_tmps(outdir, t1w_name, "_brain.nii")
         xfm_t1w2temp = mgu.name_tmps(outdir, func_name, "_xfm_t1w2temp.mat")
 
-        # Applies skull stripping to T1 volume, then EPI alignment to T1
-        mgu.extract_brain(t1w, t1w_brain, ' -B')
-        self.align_epi(func, t1w, t1w_brain, func2)
-        
-        self.align(t1w_brain, atlas_brain, xfm_t1w2temp)
+        # Skull strips the T1 volume, after which EPI alignment to T1 and
+        # alignment of the T1 brain to the template run concurrently
+        steps = [('bet', lambda: self.extract_brain(t1w, t1w_brain, ' -B'),
+                  []),
+                 ('epi_reg', lambda: self.align_epi(func, t1w, t1w_brain,
+                                                    func2), ['bet']),
+                 ('t1w_xfm', lambda: self.align(t1w_brain, atlas_brain,
+                                                xfm_t1w2temp), ['bet'])]
         # Only do FNIRT at 1mm or 2mm
-        if nb.load(atlas).get_data().shape in [(182, 218, 182), (91, 109, 91)]:
+        fnirt = nb.load(atlas).shape in [(182, 218, 182), (91, 109, 91)]
+        if fnirt:
             warp_t1w2temp = mgu.name_tmps(outdir, func_name,
-                                          "_warp_t1w2temp.nii.gz")
-
-            self.align_nonlinear(t1w, atlas, xfm_t1w2temp, warp_t1w2temp,
-                                 mask=atlas_mask)
-
-            self.apply_warp(func2, temp_aligned, atlas, warp_t1w2temp) 
-            self.apply_warp(t1w, aligned_t1w, atlas, warp_t1w2temp,
-                            mask=atlas_mask)
-        else:
-            self.applyxfm(func2, atlas, xfm_t1w2temp, temp_aligned)
+                                          "_warp_t1w2temp.nii")
+
+            steps += [('fnirt', lambda: self.align_nonlinear(
+                          t1w, atlas, xfm_t1w2temp, warp_t1w2temp,
+                          mask=atlas_mask), ['t1w_xfm']),
+                      ('warp_func', lambda: self.apply_warp(
+                          func2, temp_aligned, atlas, warp_t1w2temp),
+                       ['epi_reg', 'fnirt']),
+                      ('warp_t1w', lambda: self.apply_warp(
+                          t1w, aligned_t1w, atlas, warp_t1w2temp,
+                          mask=atlas_mask), ['fnirt']),
+                      ('resample', lambda: self.resample(
+                          temp_aligned, aligned_func, atlas), ['warp_func'])]
+        run_steps(steps)
+        if not fnirt:
+            # applyxfm outputs on the atlas grid, so needn't be resampled.
+            # It forks a pool of processes, so runs once no steps' threads
+            # are left running
+            self.applyxfm(func2, atlas, xfm_t1w2temp, aligned_func,
+                          n_jobs=n_jobs)
             self.applyxfm(t1w, atlas, xfm_t1w2temp, aligned_t1w)
 
-        self.resample(temp_aligned, aligned_func, atlas)
-
 
     def dwi2atlas(self, dwi, gtab, t1w, atlas,
-                  aligned_dwi, outdir, clean=False):
+                  aligned_dwi, outdir, clean=False, n_jobs=1):
         """
         Aligns two images and stores the transform between them
 
@@ -309,48 +476,284 @@ class register(object):
                     - Aligned output dwi image as a nifti image file
                 outdir:
                     - Directory for derivatives to be stored
+
+        **Optional Arguments:**
+
+                clean:
+                    - Whether to delete intermediate files
+                n_jobs:
+                    - Number of processes over which volumes are registered
+                      and resampled
         """
         # Creates names for all intermediate files used
         dwi_name = mgu.get_filename(dwi)
         t1w_name = mgu.get_filename(t1w)
         atlas_name = mgu.get_filename(atlas)
 
-        dwi2 = mgu.name_tmps(outdir, dwi_name, "_t2.nii.gz")
-        temp_aligned = mgu.name_tmps(outdir, dwi_name, "_ta.nii.gz")
-        temp_aligned2 = mgu.name_tmps(outdir, dwi_name, "_ta2.nii.gz")
-        b0 = mgu.name_tmps(outdir, dwi_name, "_b0.nii.gz")
-        t1w_brain = mgu.name_tmps(outdir, t1w_name, "_ss.nii.gz")
+        # Intermediate images are written uncompressed, as FSL reads them
+        # back in the following steps
+        dwi2 = mgu.name_tmps(outdir, dwi_name, "_t2.nii")
+        temp_aligned = mgu.name_tmps(outdir, dwi_name, "_ta.nii")
+        b0 = mgu.name_tmps(outdir, dwi_name, "_b0.nii")
+        t1w_brain = mgu.name_tmps(outdir, t1w_name, "_ss.nii")
         xfm = mgu.name_tmps(outdir, t1w_name,
                             "_" + atlas_name + "_xfm.mat")
 
-        # Align DTI volumes to each other
-        self.align_slices(dwi, dwi2, np.where(gtab.b0s_mask)[0][0])
-
-        # Loads DTI image in as data and extracts B0 volume
-        dwi_im = nb.load(dwi2)
-        b0_im = mgu.get_b0(gtab, dwi_im.get_data())
-
-        # Wraps B0 volume in new nifti image
-        b0_head = dwi_im.get_header()
-        b0_head.set_data_shape(b0_head.get_data_shape()[0:3])
-        b0_out = nb.Nifti1Image(b0_im, affine=dwi_im.get_affine(),
-                                header=b0_head)
-        b0_out.update_header()
-        nb.save(b0_out, b0)
-
-        # Applies skull stripping to T1 volume, then EPI alignment to T1
-        mgu.extract_brain(t1w, t1w_brain, ' -B')
-        self.align_epi(dwi2, t1w, t1w_brain, temp_aligned)
-
-        # Applies linear registration from T1 to template
-        self.align(t1w, atlas, xfm)
-
-        # Applies combined transform to dwi image volume
-        self.applyxfm(temp_aligned, atlas, xfm, temp_aligned2)
-        self.resample(temp_aligned2, aligned_dwi, atlas)
+        def save_b0():
+            # Loads DTI image in as data and extracts B0 volume
+            dwi_im = nb.load(dwi2)
+            b0_im = mgu.get_b0(gtab, dwi_im.get_data())
+
+            # Wraps B0 volume in new nifti image
+            b0_head = dwi_im.get_header()
+            b0_head.set_data_shape(b0_head.get_data_shape()[0:3])
+            b0_out = nb.Nifti1Image(b0_im, affine=dwi_im.get_affine(),
+                                    header=b0_head)
+            b0_out.update_header()
+            nb.save(b0_out, b0)
+
+        # The T1 branch (skull stripping, and linear registration from T1 to
+        # template) runs alongside the alignment of the DTI volumes to each
+        # other; EPI alignment to T1 then needs both. The combined transform
+        # is then applied directly onto the voxel grid of the atlas, after
+        # the other steps, as it forks a pool of processes.
+        idx = np.where(gtab.b0s_mask)[0][0]
+        run_steps([
+            ('eddy', lambda: self.align_slices(dwi, dwi2, idx,
+                                               n_jobs=n_jobs), []),
+            ('b0', save_b0, ['eddy']),
+            ('bet', lambda: self.extract_brain(t1w, t1w_brain, ' -B'), []),
+            ('t1w_xfm', lambda: self.align(t1w, atlas, xfm), []),
+            ('epi_reg', lambda: self.align_epi(dwi2, t1w, t1w_brain,
+                                               temp_aligned),
+             ['eddy', 'bet'])])
+        self.applyxfm(temp_aligned, atlas, xfm, aligned_dwi, n_jobs=n_jobs)
 
         if clean:
             cmd = "rm -f {} {} {} {} {}*".format(dwi2, temp_aligned, b0,
                                                  xfm, t1w_name)
             print("Cleaning temporary registration files...")
             mgu.execute_cmd(cmd)
+
+
+# Spline order of affine_transform for each FSL interpolation method
+INTERP_ORDER = {'nearestneighbour': 0, 'trilinear': 1, 'spline': 3}
+
+
+def fsl_scaled_voxels(affine, shape=None, zooms=None):
+    """
+    Returns the matrix from the voxel coordinates of an image to FSL's
+    scaled voxel coordinates, in which flirt transforms are expressed:
+    voxel indices times voxel sizes, with the x axis flipped if the affine
+    has a positive determinant (neurological orientation).
+
+    **Positional Arguments:**
+
+            affine:
+                - Affine of the image, or the nibabel image itself
+
+    **Optional Arguments:**
+
+            shape, zooms:
+                - Shape and voxel sizes of the grid, by default those of the
+                  image
+    """
+    if hasattr(affine, 'get_affine'):
+        shape = affine.shape if shape is None else shape
+        zooms = affine.get_header().get_zooms() if zooms is None else zooms
+        affine = affine.get_affine()
+    scaled = np.diag(list(zooms[:3]) + [1.])
+    if np.linalg.det(affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = shape[0] - 1
+        scaled = np.dot(scaled, flip)
+    return scaled
+
+
+def fsl_to_voxel(xfm, inp_im, ref_im):
+    """
+    Converts an FSL transform, from the input to the reference image, into
+    the affine from reference voxel coordinates to input voxel coordinates
+    used by scipy.ndimage.affine_transform
+    """
+    return np.dot(np.linalg.inv(fsl_scaled_voxels(inp_im)),
+                  np.dot(np.linalg.inv(xfm), fsl_scaled_voxels(ref_im)))
+
+
+def resample_volumes(data, vox, shape, order=1, n_jobs=1, dtype=np.float32):
+    """
+    Resamples a 3D volume, or each volume of a 4D stack, onto a grid of the
+    given shape. Voxels mapping outside of the input are zero. Each volume
+    is cast to dtype (rounded and clipped to its range if it is an integer
+    type, as flirt does) as it is resampled, so the output is only ever
+    held in dtype.
+
+    **Positional Arguments:**
+
+            data:
+                - 3D or 4D array
+            vox:
+                - 4x4 affine from output to input voxel coordinates
+            shape:
+                - 3D shape of the output grid
+
+    **Optional Arguments:**
+
+            order:
+                - Spline order of the interpolation (1 is trilinear)
+            n_jobs:
+                - Number of processes over which volumes are resampled
+            dtype:
+                - Data type of the output
+    """
+    dtype = np.dtype(dtype).newbyteorder('=')
+    if data.ndim == 3:
+        return _resample_volume((data, vox, shape, order, dtype))
+    out = np.zeros(tuple(shape) + data.shape[3:], dtype=dtype)
+    vols = ((data[..., t], vox, shape, order, dtype)
+            for t in range(data.shape[3]))
+    if n_jobs <= 1:
+        for t, vol in enumerate(vols):
+            out[..., t] = _resample_volume(vol)
+        return out
+
+    pool = Pool(n_jobs)
+    try:
+        for t, vol in enumerate(pool.imap(_resample_volume, vols)):
+            out[..., t] = vol
+    finally:
+        pool.close()
+        pool.join()
+    return out
+
+
+def _resample_volume(args):
+    """
+    Resamples one volume (see resample_volumes)
+    """
+    data, vox, shape, order, dtype = args
+    vol = affine_transform(np.asarray(data, dtype=np.float32), vox[:3, :3],
+                           offset=vox[:3, 3], output_shape=tuple(shape),
+                           order=order, mode='constant', cval=0.)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        np.clip(np.round(vol, out=vol), info.min, info.max, out=vol)
+    return vol.astype(dtype, copy=False)
+
+
+def save_resampled(data, affine, inp_im, fname):
+    """
+    Saves data resampled (see resample_volumes) in the data type of the
+    image it was resampled from, with the given affine. 3D images are kept
+    in the image registry for the stages reading them next; 4D stacks are
+    not, so that they aren't held in memory while only part is used.
+    """
+    header = inp_im.get_header().copy()
+    img = nb.Nifti1Image(data, affine, header=header)
+    img.update_header()
+    if data.ndim == 3:
+        mgu.save_image(img, fname)
+    else:
+        nb.save(img, fname)
+
+
+def run_steps(steps):
+    """
+    Runs the steps of a registration as a dependency graph: each step runs
+    in its own thread as soon as the steps it depends on are done, so that
+    independent branches (mostly waiting on FSL subprocesses) overlap. If
+    a step fails, those depending on it are skipped and, once the running
+    steps finish, the first failure in step order is raised again here,
+    including the SystemExit of a failed execute_cmd. Steps shouldn't
+    start process pools, as forking while other threads run can deadlock.
+
+    **Positional Arguments:**
+
+            steps:
+                - List of (name, function, names of the steps it depends
+                  on) tuples
+    """
+    done = dict((name, threading.Event()) for name, func, deps in steps)
+    errors = {}
+
+    def run(name, func, deps):
+        try:
+            for dep in deps:
+                done[dep].wait()
+            failed = [dep for dep in deps if dep in errors]
+            if failed:
+                errors[name] = errors[failed[0]]
+            else:
+                func()
+        except BaseException as e:
+            errors[name] = e
+        finally:
+            done[name].set()
+
+    threads = [threading.Thread(target=run, args=step) for step in steps]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for name, func, deps in steps:
+        if name in errors:
+            raise errors[name]
+
+
+def run_cmds(cmds, n_jobs=1):
+    """
+    Runs shell commands with at most n_jobs running at once. Each runs in a
+    subprocess, so the threads only wait on them. Exits, as execute_cmd
+    does, if any of the commands fail.
+    """
+    pool = ThreadPool(max(n_jobs, 1))
+    try:
+        errors = pool.map(_run_cmd, cmds)
+    finally:
+        pool.close()
+        pool.join()
+    errors = [e for e in errors if e is not None]
+    if errors:
+        sys.exit(errors[0])
+
+
+def _run_cmd(cmd):
+    """
+    Runs a shell command, returning the exit message if it fails rather
+    than exiting from a pool thread
+    """
+    try:
+        mgu.execute_cmd(cmd)
+    except SystemExit as e:
+        return e.code
+
+
+def xfm_cache_key(step, inputs, params, roles):
+    """
+    Returns the key of a registration step in the transform cache: the hash
+    of the step name, the contents of its inputs, its parameters and the
+    roles of the outputs requested, with their extensions
+    """
+    md5 = hashlib.md5()
+    md5.update(json.dumps([step, [file_hash(f) for f in inputs], params,
+                           roles], sort_keys=True).encode('utf-8'))
+    return md5.hexdigest()
+
+
+def image_ext(fname):
+    """
+    Returns the extension of a file, counting .nii.gz as one
+    """
+    if fname.endswith('.nii.gz'):
+        return '.nii.gz'
+    return op.splitext(fname)[1]
+
+
+def fsl_ext():
+    """
+    Returns the extension of the images FSL writes, per FSLOUTPUTTYPE
+    """
+    if os.environ.get('FSLOUTPUTTYPE') == 'NIFTI':
+        return '.nii'
+    return '.nii.gz'
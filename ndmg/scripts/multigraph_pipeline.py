@@ -25,11 +25,14 @@ from subprocess import Popen, PIPE
 import os.path as op
 import nibabel as nb
 import ndmg.graph as mgg
+from ndmg.graph.graph import make_graphs
+from ndmg.track.fibers import fiber_array
 import ndmg.utils as mgu
 import numpy as np
 
 
-def multigraphs(fibers, labels, outdir, gformat='gpickle'):
+def multigraphs(fibers, labels, outdir, gformat='gpickle', n_jobs=1,
+                edge_attrs=(), endpoints=None):
     """
     Creates a brain graph from fiber streamlines
     """
@@ -48,19 +51,16 @@ def multigraphs(fibers, labels, outdir, gformat='gpickle'):
     print "Graphs of streamlines downsampled to given labels: " +\
           (", ".join([x for x in graphs]))
 
-    # Load fibers
-    print "Loading fibers..."
-    fiber_npz = np.load(fibers)
-    tracks = fiber_npz[fiber_npz.keys()[0]]
-
-    # Generate graphs from streamlines for each parcellation
-    for idx, label in enumerate(label_name):
-        print "Generating graph for " + label + " parcellation..."
-        labels_im = nb.load(labels[idx])
-        g1 = mgg(len(np.unique(labels_im.get_data()))-1, labels[idx])
-        g1.make_graph(tracks)
+    # Generate graphs from streamlines for all parcellations in one pass,
+    # reading the memory-mapped fibers from disk in batches
+    print "Generating graphs for " + str(len(labels)) + " parcellations..."
+    fibs = fiber_array.load(fibers, mmap_mode='r')
+    graph_set = make_graphs(fibs, labels, backend='sparse', n_jobs=n_jobs,
+                            edge_attrs=edge_attrs, endpoints=endpoints)
+    for idx, g1 in enumerate(graph_set):
+        print "Saving graph for " + label_name[idx] + " parcellation..."
         g1.summary()
-        g1.save_graph(graphs[idx])
+        g1.save_graph(graphs[idx], fmt=gformat)
 
     print "Execution took: " + str(datetime.now() - startTime)
     print "Complete!"
@@ -70,11 +70,24 @@ def multigraphs(fibers, labels, outdir, gformat='gpickle'):
 def main():
     parser = ArgumentParser(description="This is an end-to-end connectome \
                             estimation pipeline from sMRI and DTI images")
-    parser.add_argument("fibers", action="store", help="DTI streamlines")
+    parser.add_argument("fibers", action="store", help="DTI streamlines \
+                        (.npy fibers file, or .npz from older versions)")
     parser.add_argument("outdir", action="store", help="Path to which \
                         derivatives will be stored")
     parser.add_argument("labels", action="store", nargs="*", help="Nifti \
                         labels of regions of interest in atlas space")
+    parser.add_argument("-f", "--fmt", default='gpickle',
+                        choices=['gpickle', 'graphml', 'edgelist', 'npz'],
+                        help="Determines graph output format. Edge \
+                        attributes are only kept by gpickle, graphml and npz")
+    parser.add_argument("-n", "--n_jobs", type=int, default=1,
+                        help="Number of processes used for graph generation")
+    parser.add_argument("-a", "--edge_attrs", nargs="*", default=[],
+                        choices=['mean_length', 'inv_length', 'vol_norm'],
+                        help="Edge attributes to compute besides fiber count")
+    parser.add_argument("-e", "--endpoints", type=int, default=None,
+                        help="Connect only the ROIs at the ends of each fiber, \
+                        searching this many points in from each end")
     result = parser.parse_args()
 
     # Create output directory
@@ -84,7 +97,9 @@ def main():
     p = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
     p.communicate()
 
-    multigraphs(result.fibers, result.labels, result.outdir)
+    multigraphs(result.fibers, result.labels, result.outdir,
+                gformat=result.fmt, n_jobs=result.n_jobs, edge_attrs=result.edge_attrs,
+                endpoints=result.endpoints)
 
 
 if __name__ == "__main__":
@@ -91,6 +91,9 @@ def get_atlas(atlas_dir, dwi=True):
         print("Cannot find atlas information; please download and unzip as follows...")
         print("Source: s3://mrneurodata/data/resources/ndmg_atlases.zip")
         print("Destination: {}".format(atlas_dir))
+    else:
+        # Builds (or validates) the label index once per atlas, not per graph
+        [mgu.load_atlas_index(l) for l in labels]
 
     if dwi:
         atlas_brain = None
@@ -99,11 +102,14 @@ def get_atlas(atlas_dir, dwi=True):
 
 
 def session_level(inDir, outDir, subjs, sesh=None, debug=False,
-                      stc=None, dwi=True):
+                      stc=None, dwi=True, xfm_cache=None, n_jobs=1):
     """
     Crawls the given BIDS organized directory for data pertaining to the given
     subject and session, and passes necessary files to ndmg_pipeline for
-    processing.
+    processing. If xfm_cache is given, registration transforms are cached
+    there and shared between sessions, e.g. those of a longitudinal subject
+    with the same anatomical scan. n_jobs processes are used by each stage
+    of the pipeline which runs in parallel.
     """
     labels, atlas, atlas_mask, atlas_brain, lv_maks = get_atlas(atlas_dir, dwi)
 
@@ -126,7 +132,8 @@ def session_level(inDir, outDir, subjs, sesh=None, debug=False,
             print("Bvec file: {}".format(bvec[i]))
 
             ndmg_dwi_pipeline(dwi[i], bval[i], bvec[i], anat[i], atlas,
-                              atlas_mask, labels, outDir, clean=(not debug))
+                              atlas_mask, labels, outDir, clean=(not debug),
+                              n_jobs=n_jobs, xfm_cache=xfm_cache)
 
 
 def group_level(inDir, outDir, dataset=None, atlas=None, minimal=False,
@@ -159,7 +166,8 @@ def group_level(inDir, outDir, dataset=None, atlas=None, minimal=False,
         fs = [op.join(tmp_in, fl)
               for root, dirs, files in os.walk(tmp_in)
               for fl in files
-              if fl.endswith(".graphml") or fl.endswith(".gpickle") or fl.endswith('edgelist')]
+              if fl.endswith(".graphml") or fl.endswith(".gpickle") or
+              fl.endswith('edgelist') or fl.endswith('.npz')]
         tmp_out = op.join(outDir, label)
         mgu.execute_cmd("mkdir -p {}".format(tmp_out))
         try:
@@ -226,6 +234,13 @@ def main():
     parser.add_argument('--debug', action='store_true', help='flag to store '
                         'temp files along the path of processing.',
                         default=False)
+    parser.add_argument('--xfm_cache', action='store_true', help='Cache '
+                        'registration transforms in <output_dir>/xfm_cache, '
+                        'which is kept between runs, so that sessions sharing '
+                        'an anatomical scan reuse them.', default=False)
+    parser.add_argument('--n_jobs', type=int, default=1, help='Number of '
+                        'processes used for registration, tensor fitting, '
+                        'tracking and graph generation.')
     result = parser.parse_args()
 
     inDir = result.bids_dir
@@ -237,6 +252,7 @@ def main():
     push = result.push_data
     level = result.analysis_level
     debug = result.debug
+    xfm_cache = op.join(outDir, 'xfm_cache') if result.xfm_cache else None
     
     minimal = result.minimal
     log = result.log
@@ -265,7 +281,8 @@ def main():
             else: 
                 s3_get_data(buck, remo, inDir, public=creds)
         modif = 'ndmg'
-        session_level(inDir, outDir, subj, sesh, debug)
+        session_level(inDir, outDir, subj, sesh, debug, xfm_cache=xfm_cache,
+                      n_jobs=result.n_jobs)
 
     elif level == 'group':
         if buck is not None and remo is not None:
@@ -30,15 +30,18 @@ from ndmg.stats.qa_fibers import *
 import ndmg.utils as mgu
 import ndmg.register as mgr
 import ndmg.track as mgt
-import ndmg.graph as mgg
+from ndmg.graph.graph import make_graphs
+from ndmg.track.fibers import offsets_file
 import ndmg.preproc as mgp
 import numpy as np
-import nibabel as nb
 import os
 
 
 def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
-                  clean=False, fmt='edgelist'):
+                  clean=False, fmt='edgelist', n_jobs=1, edge_attrs=(),
+                  endpoints=None, seed_stride=1, seed_density=1, seed_fa=None,
+                  max_seeds=None, fiber_fmt=None, dtype=None, cache=False,
+                  engine='eudx', model='tensor', xfm_cache=None):
     """
     Creates a brain graph from MRI data
     """
@@ -63,7 +66,7 @@ def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
     # Create derivative output file names
     aligned_dwi = "{}/reg/dwi/{}_aligned.nii.gz".format(outdir, dwi_name)
     tensors = "{}/tensors/{}_tensors.npz".format(outdir, dwi_name)
-    fibers = "{}/fibers/{}_fibers.npz".format(outdir, dwi_name)
+    fibers = "{}/fibers/{}_fibers.npy".format(outdir, dwi_name)
     print("This pipeline will produce the following derivatives...")
     print("DWI volume registered to atlas: {}".format(aligned_dwi))
     print("Diffusion tensors in atlas space: {}".format(tensors))
@@ -75,44 +78,71 @@ def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
     print("Graphs of streamlines downsampled to given labels: " +
           ", ".join([x for x in graphs]))
 
+    # If asked, tensors, fibers and registration transforms are cached so
+    # reruns with the same inputs, and sessions sharing an anatomical, reuse
+    # them. A transform cache given explicitly is used, and kept, regardless
+    cache_dir = "{}/tmp/track".format(outdir) if cache else None
+    tmp_caches = [cache_dir] if cache else []
+    if cache and xfm_cache is None:
+        xfm_cache = "{}/tmp/xfm".format(outdir)
+        tmp_caches += [xfm_cache]
+
     # Creates gradient table from bvalues and bvectors
     print("Generating gradient table...")
-    dwi1 = "{}/tmp/{}_t1.nii.gz".format(outdir, dwi_name)
+    # Written uncompressed, as FSL reads it back during registration
+    dwi1 = "{}/tmp/{}_t1.nii".format(outdir, dwi_name)
     bvecs1 = "{}/tmp/{}_1.bvec".format(outdir, dwi_name)
     mgp.rescale_bvec(bvecs, bvecs1)
-    gtab = mgu.load_bval_bvec_dwi(bvals, bvecs1, dwi, dwi1)
+    gtab = mgu.load_bval_bvec_dwi(bvals, bvecs1, dwi, dwi1, dtype=dtype)
 
     # Align DWI volumes to Atlas
     print("Aligning volumes...")
-    mgr().dwi2atlas(dwi1, gtab, mprage, atlas, aligned_dwi, outdir, clean)
+    mgr(cache_dir=xfm_cache).dwi2atlas(dwi1, gtab, mprage, atlas, aligned_dwi,
+                                       outdir, clean, n_jobs=n_jobs)
     loc0 = np.where(gtab.b0s_mask)[0][0]
     reg_mri_pngs(aligned_dwi, atlas, "{}/qa/reg/dwi/".format(outdir), loc=loc0)
 
     print("Beginning tractography...")
     # Compute tensors and track fiber streamlines
-    tens, tracks = mgt().eudx_basic(aligned_dwi, mask, gtab, stop_val=0.2)
+    tracker = mgt()
+    tens, tracks = tracker.eudx_basic(aligned_dwi, mask, gtab, stop_val=0.2,
+                                      n_jobs=n_jobs, stride=seed_stride,
+                                      density=seed_density, fa_thresh=seed_fa,
+                                      max_seeds=max_seeds, dtype=dtype,
+                                      cache_dir=cache_dir, engine=engine,
+                                      model=model)
     tensor2fa(tens, tensors, aligned_dwi, "{}/tensors/".format(outdir),
-              "{}/qa/tensors/".format(outdir))
-
-    # As we've only tested VTK plotting on MNI152 aligned data...
-    if nb.load(mask).get_data().shape == (182, 218, 182):
-        try:
-            visualize_fibs(tracks, fibers, mask,
-                           "{}/qa/fibers/".format(outdir), 0.02)
-        except:
-            print("Fiber QA failed - VTK for Python not configured properly.")
+              "{}/qa/tensors/".format(outdir), bbox=tracker.bbox,
+              dtype=dtype)
 
     # And save them to disk
-    np.savez(tensors, tens)
-    np.savez(fibers, tracks)
+    # Tensors cover only the tracked region, so its bounds are kept too
+    np.savez(tensors, tens,
+             bbox=np.array([[s.start, s.stop] for s in tracker.bbox]))
+    tracks.save(fibers)
+    if fiber_fmt is not None:
+        tracks.export(fibers.replace('.npy', '.' + fiber_fmt),
+                      mgu.load_image(mask))
 
-    # Generate graphs from streamlines for each parcellation
-    for idx, label in enumerate(label_name):
-        print("Generating graph for {} parcellation...".format(label))
-
-        labels_im = nb.load(labels[idx])
-        g1 = mgg(len(np.unique(labels_im.get_data()))-1, labels[idx])
-        g1.make_graph(tracks)
+    # As we've only tested VTK plotting on MNI152 aligned data...
+    # Fibers are sampled from the saved file rather than held in memory
+    if mgu.load_image(mask).shape == (182, 218, 182):
+        try:
+            visualize_fibs(None, fibers, mask,
+                           "{}/qa/fibers/".format(outdir), 0.02, 5000)
+        except (AttributeError, RuntimeError, ValueError) as e:
+            print("Fiber QA failed - VTK for Python not configured "
+                  "properly: {}".format(e))
+
+    # Images handed between the stages above are no longer needed
+    mgu.clear_images()
+
+    # Generate graphs from streamlines for all parcellations in one pass
+    print("Generating graphs for {} parcellations...".format(len(labels)))
+    graph_set = make_graphs(tracks, labels, backend='sparse', n_jobs=n_jobs,
+                            edge_attrs=edge_attrs, endpoints=endpoints)
+    for idx, g1 in enumerate(graph_set):
+        print("Saving graph for {} parcellation...".format(label_name[idx]))
         g1.summary()
         g1.save_graph(graphs[idx], fmt=fmt)
 
@@ -121,9 +151,12 @@ def ndmg_dwi_pipeline(dwi, bvals, bvecs, mprage, atlas, mask, labels, outdir,
     # Clean temp files
     if clean:
         print("Cleaning up intermediate files... ")
-        cmd = 'rm -f {} tmp/{}* {} {}'.format(tensors, dwi_name,
-                                               aligned_dwi, fibers)
+        cmd = 'rm -f {} tmp/{}* {} {} {}'.format(tensors, dwi_name,
+                                                  aligned_dwi, fibers,
+                                                  offsets_file(fibers))
         mgu.execute_cmd(cmd)
+        if tmp_caches:
+            mgu.execute_cmd('rm -rf ' + ' '.join(tmp_caches))
 
     print("Complete!")
 
@@ -145,8 +178,47 @@ def main():
     parser.add_argument("-c", "--clean", action="store_true", default=False,
                         help="Whether or not to delete intemediates")
     parser.add_argument("-f", "--fmt", default='edgelist',
-                        choices=['gpickle', 'graphml', 'edgelist'],
+                        choices=['gpickle', 'graphml', 'edgelist', 'npz'],
                         help="Determines graph output format")
+    parser.add_argument("-n", "--n_jobs", type=int, default=1,
+                        help="Number of processes used for resampling, \
+                        tensor fitting, tracking and graph generation")
+    parser.add_argument("-a", "--edge_attrs", nargs="*", default=[],
+                        choices=['mean_length', 'inv_length', 'vol_norm'],
+                        help="Edge attributes to compute besides fiber count \
+                        (stored in gpickle and graphml graphs)")
+    parser.add_argument("-e", "--endpoints", type=int, default=None,
+                        help="Connect only the ROIs at the ends of each fiber, \
+                        searching this many points in from each end")
+    parser.add_argument("--seed_stride", type=int, default=1,
+                        help="Seed only every n-th voxel along each axis")
+    parser.add_argument("--seed_density", type=int, default=1,
+                        help="Number of randomly placed seeds per voxel")
+    parser.add_argument("--seed_fa", type=float, default=None,
+                        help="Seed only voxels with FA above this threshold")
+    parser.add_argument("--max_seeds", type=int, default=None,
+                        help="Randomly subsample seeds to at most this many")
+    parser.add_argument("-x", "--fiber_fmt", default=None,
+                        choices=['trk', 'tck'],
+                        help="Also export the fibers in this format")
+    parser.add_argument("--float32", action="store_true", default=False,
+                        help="Hold tensors and FA in float32, and narrow \
+                        float64 DWI volumes to it (integer volumes are kept)")
+    parser.add_argument("-t", "--tracker", default='eudx',
+                        choices=['eudx', 'lockstep'],
+                        help="Tracking engine: dipy's EuDX, or a tracker \
+                        advancing all streamlines together")
+    parser.add_argument("-m", "--model", default='tensor',
+                        choices=['tensor', 'csd'],
+                        help="Model whose peak directions are tracked")
+    parser.add_argument("--cache", action="store_true", default=False,
+                        help="Cache transforms, tensors and fibers in \
+                        <outdir>/tmp so reruns with the same inputs reuse \
+                        them (removed with --clean)")
+    parser.add_argument("--xfm_cache", default=None,
+                        help="Directory of a registration transform cache, \
+                        which may be shared between runs and is kept after \
+                        --clean (default with --cache: <outdir>/tmp/xfm)")
     result = parser.parse_args()
 
     # Create output directory
@@ -158,7 +230,13 @@ def main():
 
     ndmg_dwi_pipeline(result.dwi, result.bval, result.bvec, result.mprage,
                       result.atlas, result.mask, result.labels, result.outdir,
-                      result.clean, result.fmt)
+                      result.clean, result.fmt, result.n_jobs,
+                      result.edge_attrs, result.endpoints, result.seed_stride,
+                      result.seed_density, result.seed_fa, result.max_seeds,
+                      result.fiber_fmt,
+                      np.float32 if result.float32 else None,
+                      result.cache, result.tracker, result.model,
+                      result.xfm_cache)
 
 
 if __name__ == "__main__":
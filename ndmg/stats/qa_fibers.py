@@ -28,6 +28,7 @@ import subprocess
 
 from dipy.viz import window, actor
 from argparse import ArgumentParser
+from ndmg.track.fibers import fiber_array
 
 try:
     import vtk
@@ -38,6 +39,7 @@ def visualize_fibs(fibs, fibfile, atlasfile, outdir, opacity, num_samples):
     """
     Takes fiber streamlines and visualizes them using DiPy
     Required Arguments:
+        - fibs: Fiber streamlines, or None to stream them from fibfile
         - fibfile: Path to fiber file
         - atlasfile: Path to atlas file
         - outdir: Path to output directory
@@ -52,7 +54,10 @@ def visualize_fibs(fibs, fibfile, atlasfile, outdir, opacity, num_samples):
         print("!! VTK not found; skipping fiber QA.")
         return
 
-    # loading the fibers
+    # loading the fibers; a .npy fibers file is memory-mapped, so only the
+    # sampled fibers are read
+    if fibs is None:
+        fibs = fiber_array.load(fibfile, mmap_mode='r')
     fibs = threshold_fibers(fibs)
 
     # make sure if fiber streamlines
@@ -70,7 +75,7 @@ def visualize_fibs(fibs, fibfile, atlasfile, outdir, opacity, num_samples):
     renderer.SetBackground(1.0, 1.0, 1.0)
 
     # Add streamlines as a DiPy viz object
-    stream_actor = actor.line(fibs)
+    stream_actor = actor.line([np.asarray(f) for f in resampled_fibs])
 
     # Set camera orientation properties
     # TODO: allow this as an argument
@@ -90,8 +95,13 @@ def visualize_fibs(fibs, fibfile, atlasfile, outdir, opacity, num_samples):
 
 def threshold_fibers(fibs):
     '''
-    fibs: fibers as 2D array (N,3)
+    fibs: fibers as 2D array (N,3), or a fiber_array
     '''
+    if isinstance(fibs, fiber_array):
+        if not len(fibs):
+            return fibs
+        # select by the stored lengths, without touching the points
+        return fibs[np.where(fibs.lengths > np.median(fibs.lengths))[0]]
     fib_lengths = [len(f) for f in fibs]
     if (len(fib_lengths) == 0):
         return fib_lengths
@@ -41,15 +41,16 @@ def reg_mri_pngs(mri, atlas, outdir, loc=0, mean=False, dim=4):
     fname: name of output file WITHOUT FULL PATH. Path provided in outdir.
     """
 
-    atlas_data = nb.load(atlas).get_data()
-    mri_data = nb.load(mri).get_data()
+    atlas_data = mgu.load_image(atlas).get_data()
+    mri_im = nb.load(mri)
     if dim==4:  # 4d data, so we need to reduce a dimension
         if mean:
-            b0_data = mri_data.mean(axis=3)
+            b0_data = mri_im.get_data().mean(axis=3)
         else:
-            b0_data = mri_data[:,:,:,loc]
+            # Only the volume shown is read
+            b0_data = np.asarray(mri_im.dataobj[:,:,:,loc])
     else:  # dim=3
-        b0_data = mri_data
+        b0_data = mri_im.get_data()
 
     cmap1 = LinearSegmentedColormap.from_list('mycmap1', ['black', 'magenta'])
     cmap2 = LinearSegmentedColormap.from_list('mycmap2', ['black', 'green'])
@@ -34,23 +34,36 @@ matplotlib.use('Agg')  # very important above pyplot import
 import matplotlib.pyplot as plt
 
 
-def tensor2fa(tensors, tensor_name, dwi, derivdir, qcdir):
+def tensor2fa(tensors, tensor_name, dwi, derivdir, qcdir, bbox=None,
+              dtype=None):
     '''
     outdir: location of output directory.
     fname: name of output fa map file. default is none (name created based on
     input file)
+    bbox: region of the dwi volume, as a tuple of slices, which the tensors
+    were fit in (see track.bbox). The FA map is written at full size.
+    dtype: data type, e.g. np.float32, in which to compute the FA map. By
+    default that of the tensors is used.
     '''
-    dwi_data = nb.load(dwi)
-    affine = dwi_data.get_affine()
-    dwi_data = dwi_data.get_data()
+    # Only the header of the dwi volume is needed
+    dwi_img = nb.load(dwi)
+    affine = dwi_img.get_affine()
 
     # create FA map
-    FA = fractional_anisotropy(tensors.evals)
+    evals, evecs = tensors.evals, tensors.evecs
+    if dtype is not None:
+        evals = evals.astype(dtype, copy=False)
+        evecs = evecs.astype(dtype, copy=False)
+    FA = fractional_anisotropy(evals)
     FA[np.isnan(FA)] = 0
 
     # generate the RGB FA map
     FA = np.clip(FA, 0, 1)
-    RGB = color_fa(FA, tensors.evecs)
+    RGB = color_fa(FA, evecs)
+    if bbox is not None:
+        full = np.zeros(dwi_img.shape[:3] + (3,), dtype=RGB.dtype)
+        full[bbox] = RGB
+        RGB = full
 
     fname = os.path.split(tensor_name)[1].split(".")[0] + '_fa_rgb.nii.gz'
     fa = nb.Nifti1Image(np.array(255 * RGB, 'uint8'), affine)
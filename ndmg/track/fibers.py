@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+
+# Copyright 2016 NeuroData (http://neurodata.io)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# fibers.py
+
+from __future__ import print_function
+
+from itertools import islice
+import numpy as np
+import nibabel as nb
+import os.path as op
+
+
+class fiber_array(object):
+
+    def __init__(self, points=None, offsets=None, lengths=None):
+        """
+        Fiber streamlines held in one contiguous (P, 3) float32 array of
+        points, with the offset and length of each streamline within it,
+        much like dipy's ArraySequence. Indexing with an integer gives a
+        view of one streamline; indexing with a slice or an array of
+        indices gives a fiber_array.
+
+        **Optional Arguments:**
+
+                points:
+                    - (P, 3) array of the points of every streamline
+                offsets:
+                    - (N,) index of the first point of each streamline.
+                      Defaults to the streamlines being stored back to back.
+                lengths:
+                    - (N,) number of points in each streamline
+        """
+        if points is None:
+            points = np.zeros((0, 3), dtype=np.float32)
+        if lengths is None:
+            lengths = np.zeros(0, dtype=np.intp)
+        self.points = np.asarray(points).reshape(-1, 3)
+        self.lengths = np.asarray(lengths, dtype=np.intp)
+        if offsets is None:
+            offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]])
+            offsets = offsets[:len(self.lengths)]
+        self.offsets = np.asarray(offsets, dtype=np.intp)
+
+    @classmethod
+    def from_iter(cls, streamlines, block_size=100000):
+        """
+        Packs an iterable of (n, 3) streamlines into a fiber_array, a block
+        of streamlines at a time, so that the whole list of small arrays is
+        never held in memory at once.
+        """
+        if isinstance(streamlines, cls):
+            return streamlines
+        streamlines = iter(streamlines)
+        blocks = []
+        while True:
+            block = list(islice(streamlines, block_size))
+            if not block:
+                break
+            lengths = np.array([len(s) for s in block], dtype=np.intp)
+            points = [np.asarray(s, dtype=np.float32).reshape(-1, 3)
+                      for s in block]
+            blocks += [cls(np.concatenate(points), lengths=lengths)]
+        return cls.concatenate(blocks)
+
+    @classmethod
+    def concatenate(cls, arrays):
+        """
+        Joins several fiber_arrays, in order, into one
+        """
+        if not arrays:
+            return cls()
+        arrays = [a.compact() for a in arrays]
+        return cls(np.concatenate([a.points for a in arrays]),
+                   lengths=np.concatenate([a.lengths for a in arrays]))
+
+    def compact(self):
+        """
+        Returns the streamlines stored back to back, without any points that
+        no streamline refers to. The array itself is returned if it already
+        is compact.
+        """
+        nb_points = self.lengths.sum()
+        if (len(self.points) == nb_points and
+                np.array_equal(self.offsets[1:],
+                               np.cumsum(self.lengths)[:-1]) and
+                (not len(self) or self.offsets[0] == 0)):
+            return self
+        if not nb_points:
+            return fiber_array(lengths=self.lengths)
+        idx = np.repeat(self.offsets - np.cumsum(self.lengths) +
+                        self.lengths, self.lengths) + np.arange(nb_points)
+        return fiber_array(self.points[idx], lengths=self.lengths)
+
+    @property
+    def nb_points(self):
+        """
+        Total number of points in the streamlines
+        """
+        return int(self.lengths.sum())
+
+    def fiber_ids(self):
+        """
+        Returns, for each point of the compacted array, the index of the
+        streamline it belongs to
+        """
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            start = self.offsets[idx]
+            return self.points[start:start + self.lengths[idx]]
+        if isinstance(idx, slice) and idx.step in (None, 1):
+            lengths = self.lengths[idx]
+            if not len(lengths):
+                return fiber_array(self.points[:0], lengths=lengths)
+            offsets = self.offsets[idx]
+            start = offsets.min()
+            stop = (offsets + lengths).max()
+            return fiber_array(self.points[start:stop], offsets - start,
+                               lengths)
+        return fiber_array(self.points, self.offsets[idx], self.lengths[idx])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def save(self, fname):
+        """
+        Saves the streamlines as a pair of uncompressed .npy files: the
+        compacted (P, 3) points, and the N + 1 offsets delimiting each
+        streamline in a file of the same name ending in _offsets.npy. Both
+        can be memory-mapped by load.
+
+        **Positional Arguments:**
+
+                fname:
+                    - Path of the points file, ending in .npy
+        """
+        fibers = self.compact()
+        offsets = np.concatenate([[0], np.cumsum(fibers.lengths)])
+        np.save(fname, fibers.points)
+        np.save(offsets_file(fname), offsets.astype(np.int64))
+
+    @classmethod
+    def load(cls, fname, mmap_mode=None):
+        """
+        Loads streamlines from a fibers file. With mmap_mode='r', the points
+        of a .npy fibers file are memory-mapped so that streamlines, or
+        ranges of them, are only read from disk once indexed. Files written
+        by older versions of ndmg, holding the points and lengths or a
+        pickled object array of streamlines in an .npz file, are read in
+        full.
+
+        **Positional Arguments:**
+
+                fname:
+                    - Path of the fibers file
+
+        **Optional Arguments:**
+
+                mmap_mode:
+                    - Memory-map mode passed on to np.load
+        """
+        if fname.endswith('.npy'):
+            points = np.load(fname, mmap_mode=mmap_mode)
+            offsets = np.load(offsets_file(fname))
+            return cls(points, offsets[:-1], np.diff(offsets))
+        fibers = np.load(fname, allow_pickle=True)
+        if 'points' in fibers.files:
+            return cls(fibers['points'], lengths=fibers['lengths'])
+        return cls.from_iter(fibers[fibers.files[0]])
+
+    def export(self, fname, ref):
+        """
+        Exports the streamlines to a TrackVis .trk or MRtrix .tck file,
+        depending on the extension of fname.
+
+        **Positional Arguments:**
+
+                fname:
+                    - Path of the file to write
+                ref:
+                    - Nifti image, or path to one, in whose voxel space the
+                      streamlines are, e.g. the mask used for tracking
+        """
+        if isinstance(ref, str):
+            ref = nb.load(ref)
+        # Streamlines are written one at a time rather than copied in full
+        tractogram = nb.streamlines.LazyTractogram(
+            lambda: (np.asarray(s) for s in self),
+            affine_to_rasmm=ref.affine)
+        header = None
+        if fname.endswith('.trk'):
+            Field = nb.streamlines.Field
+            header = {Field.VOXEL_TO_RASMM: ref.affine,
+                      Field.DIMENSIONS: ref.shape[:3],
+                      Field.VOXEL_SIZES: ref.header.get_zooms()[:3],
+                      Field.VOXEL_ORDER: ''.join(nb.aff2axcodes(ref.affine))}
+        nb.streamlines.save(tractogram, fname, header=header)
+
+
+def offsets_file(fname):
+    """
+    Returns the name of the offsets file paired with a .npy fibers file
+    """
+    return op.splitext(fname)[0] + '_offsets.npy'
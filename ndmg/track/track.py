@@ -20,14 +20,25 @@
 
 from __future__ import print_function
 
+from multiprocessing import Pool
 import numpy as np
 import nibabel as nb
-from dipy.reconst.dti import TensorModel, fractional_anisotropy, quantize_evecs
+import hashlib
+import json
+import os
+import os.path as op
+import shutil
+import tempfile
+from dipy.reconst.dti import (TensorModel, TensorFit, fractional_anisotropy,
+                              quantize_evecs)
 from dipy.reconst.csdeconv import (ConstrainedSphericalDeconvModel,
                                    auto_response)
 from dipy.direction import peaks_from_model
 from dipy.tracking.eudx import EuDX
 from dipy.data import get_sphere
+from ndmg.track.fibers import fiber_array, offsets_file
+from ndmg.utils.utils import (file_stamp, get_filename, load_image,
+                              narrow_dtype, stamp_matches)
 
 
 class track():
@@ -37,13 +48,21 @@ class track():
         Tensor and fiber tracking class
         """
         # WGR:TODO rewrite help text
-        pass
+        # Region of the volume, as a tuple of slices, which was last tracked
+        self.bbox = None
 
-    def eudx_basic(self, dwi_file, mask_file, gtab, stop_val=0.1):
+    def eudx_basic(self, dwi_file, mask_file, gtab, stop_val=0.1, n_jobs=1,
+                   mem_budget=2048, stride=1, density=1, fa_thresh=None,
+                   max_seeds=None, rng_seed=42, crop=True, margin=2,
+                   dtype=None, cache_dir=None, engine='eudx', model='tensor'):
         """
         Tracking with basic tensors and basic eudx - experimental
-        We now force seeding at every voxel in the provided mask for
-        simplicity.  Future functionality will extend these options.
+        By default we seed at every voxel in the provided mask; see
+        seed_points for the options which thin or densify the seeds.
+        Tensors are fit, and fibers tracked, within the bounding box of the
+        mask, which is kept in self.bbox; the returned tensors cover only
+        this box, while the fibers are in the voxel coordinates of the full
+        volume.
         **Positional Arguments:**
 
                 dwi_file:
@@ -56,24 +75,601 @@ class track():
         **Optional Arguments:**
                 stop_val:
                     - Value to cutoff fiber track
+                n_jobs:
+                    - Number of processes used to fit the tensors and track
+                mem_budget:
+                    - Approximate memory, in MB, to use for tensor fitting
+                stride, density, fa_thresh, max_seeds, rng_seed:
+                    - Seeding strategy, as described in seed_points
+                crop:
+                    - Whether to crop to the bounding box of the mask
+                margin:
+                    - Number of voxels around the mask kept when cropping
+                dtype:
+                    - Data type the tensors are held in, by default
+                      float64. np.float32 halves their memory use. The DWI
+                      volume is narrowed to it too if it is stored in a
+                      wider floating point type (see narrow_dtype).
+                cache_dir:
+                    - Directory in which to keep the tensors and fibers. If
+                      they were computed there before from the same inputs
+                      and options, they are loaded rather than recomputed.
+                engine:
+                    - Tracking engine: 'eudx' for dipy's EuDX, or 'lockstep'
+                      for lockstep_tracks, which advances all streamlines
+                      together as arrays
+                model:
+                    - Model whose peak directions are tracked: 'tensor', or
+                      'csd' for constrained spherical deconvolution, which
+                      then tracks until the GFA falls below stop_val. The
+                      tensors are fit, and returned, either way.
         """
+        if engine not in ('eudx', 'lockstep'):
+            raise ValueError("Tracking engine must be 'eudx' or 'lockstep'.")
+        if model not in ('tensor', 'csd'):
+            raise ValueError("Tracking model must be 'tensor' or 'csd'.")
+        params = {'gtab': gtab_hash(gtab), 'stop_val': stop_val,
+                  'stride': stride, 'density': density,
+                  'fa_thresh': fa_thresh, 'max_seeds': max_seeds,
+                  'rng_seed': rng_seed, 'crop': crop, 'margin': margin,
+                  'dtype': None if dtype is None else np.dtype(dtype).name,
+                  'engine': engine, 'model': model}
+        if cache_dir is not None:
+            cached = load_track_cache(cache_dir, dwi_file, mask_file, gtab,
+                                      params)
+            if cached is not None:
+                print("Reusing tensors and fibers cached in " + cache_dir)
+                ten, tracks, self.bbox = cached
+                return (ten, tracks)
 
-        img = nb.load(dwi_file)
-        data = img.get_data()
-
-        img = nb.load(mask_file)
+        # Images saved earlier in the pipeline are taken from memory
+        img = load_image(mask_file)
 
         mask = img.get_data()
+        if not np.any(mask):
+            # Nothing to fit or track: zero tensors over the whole volume
+            print("The mask is empty; no fibers are tracked.")
+            self.bbox = tuple(slice(0, n) for n in mask.shape[:3])
+            params = np.zeros(mask.shape[:3] + (12,),
+                              dtype=dtype or np.float64)
+            return (TensorFit(TensorModel(gtab), params), fiber_array())
+        if crop:
+            self.bbox = mask_bbox(mask, margin)
+        else:
+            self.bbox = tuple(slice(0, n) for n in mask.shape[:3])
+        mask = mask[self.bbox]
 
-        # use all points in mask
-        seedIdx = np.where(mask > 0)  # seed everywhere not equal to zero
-        seedIdx = np.transpose(seedIdx)
+        # Only the cropped region of the DWI volume is read into memory
+        img = nb.load(dwi_file)
+        data = np.asarray(img.dataobj[self.bbox],
+                          dtype=narrow_dtype(img.get_data_dtype(), dtype))
 
-        model = TensorModel(gtab)
-        ten = model.fit(data, mask)
+        ten = fit_tensors(data, mask, gtab, n_jobs, mem_budget,
+                          dtype or np.float64)
+        seedIdx = seed_points(mask, fa=ten.fa, stride=stride, density=density,
+                              fa_thresh=fa_thresh, max_seeds=max_seeds,
+                              rng_seed=rng_seed,
+                              origin=[s.start for s in self.bbox])
         sphere = get_sphere('symmetric724')
-        ind = quantize_evecs(ten.evecs, sphere.vertices)
-        eu = EuDX(a=ten.fa, ind=ind, seeds=seedIdx,
-                  odf_vertices=sphere.vertices, a_low=stop_val)
-        tracks = [e for e in eu]
+        if model == 'csd':
+            response = csd_response(gtab, data, dwi_file, self.bbox,
+                                    cache_dir)
+            peaks = csd_peaks(gtab, data, mask, response, sphere, n_jobs)
+            anis, ind = peaks.gfa, peaks.peak_indices[..., 0]
+            dirs = peaks.peak_dirs[..., 0, :]
+        else:
+            anis, ind = ten.fa, None
+            dirs = ten.evecs[..., 0]
+
+        print("Tracking from {} seeds...".format(len(seedIdx)))
+        if engine == 'lockstep':
+            tracks = lockstep_tracks(anis, dirs, seedIdx, stop_val)
+        else:
+            if ind is None:
+                ind = quantize_evecs(ten.evecs, sphere.vertices)
+            tracks = eudx_tracks(anis, ind, seedIdx, sphere.vertices,
+                                 stop_val, n_jobs)
+        tracks.points += np.array([s.start for s in self.bbox],
+                                  dtype=tracks.points.dtype)
+        if cache_dir is not None:
+            save_track_cache(cache_dir, dwi_file, mask_file, params, ten,
+                             tracks, self.bbox)
         return (ten, tracks)
+
+
+# Response functions estimated this session, keyed by DWI volume and region
+_RESPONSES = {}
+
+
+def csd_response(gtab, data, dwi_file, bbox, cache_dir=None):
+    """
+    Estimates the single fiber response function for CSD with auto_response.
+    Responses are kept for the rest of the session, and in cache_dir if
+    given, so that reruns on the same DWI volume skip the estimation.
+
+    **Positional Arguments:**
+
+            gtab:
+                - dipy formatted bval/bvec Structure
+            data:
+                - 4D DWI volume, cropped to bbox
+            dwi_file:
+                - File data was read from
+            bbox:
+                - Region of the volume, as a tuple of slices, held in data
+
+    **Optional Arguments:**
+
+            cache_dir:
+                - Directory in which to keep the response on disk
+    """
+    stat = os.stat(dwi_file)
+    region = [[s.start, s.stop] for s in bbox]
+    inputs = {'gtab': gtab_hash(gtab), 'bbox': region}
+    key = (op.abspath(dwi_file), stat.st_size, stat.st_mtime,
+           inputs['gtab'], str(region))
+    if key in _RESPONSES:
+        return _RESPONSES[key]
+
+    response_file = None
+    if cache_dir is not None:
+        response_file = op.join(cache_dir,
+                                get_filename(dwi_file) + '_response.json')
+        if op.isfile(response_file):
+            with open(response_file) as f:
+                cached = json.load(f)
+            if cached['inputs'] == inputs and \
+                    stamp_matches(dwi_file, cached['dwi']):
+                response = (np.array(cached['evals']), cached['S0'])
+                _RESPONSES[key] = response
+                return response
+
+    response, ratio = auto_response(gtab, data, roi_radius=10, fa_thr=0.7)
+    print("Response function eigenvalue ratio: {}".format(ratio))
+    _RESPONSES[key] = response
+    if response_file is not None:
+        try:
+            if not op.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            with open(response_file, 'w') as f:
+                json.dump({'dwi': file_stamp(dwi_file), 'inputs': inputs,
+                           'evals': np.asarray(response[0]).tolist(),
+                           'S0': float(response[1])}, f)
+        except (IOError, OSError) as e:
+            print("Could not cache response in {}: {}".format(cache_dir, e))
+    return response
+
+
+def csd_peaks(gtab, data, mask, response, sphere, n_jobs=1):
+    """
+    Fits the CSD model and extracts the peaks of its fODFs, in n_jobs
+    processes
+    """
+    csd_model = ConstrainedSphericalDeconvModel(gtab, response)
+    return peaks_from_model(model=csd_model, data=data, sphere=sphere,
+                            relative_peak_threshold=.5,
+                            min_separation_angle=25, mask=mask,
+                            return_sh=False, parallel=n_jobs > 1,
+                            nbr_processes=n_jobs)
+
+
+def gtab_hash(gtab):
+    """
+    Returns the md5 hash of the b-values and b-vectors of a gradient table
+    """
+    md5 = hashlib.md5()
+    md5.update(np.ascontiguousarray(gtab.bvals, dtype=np.float64).tobytes())
+    md5.update(np.ascontiguousarray(gtab.bvecs, dtype=np.float64).tobytes())
+    return md5.hexdigest()
+
+
+def track_cache_files(cache_dir, dwi_file):
+    """
+    Returns the names of the manifest, tensors and fibers files cached for a
+    DWI volume
+    """
+    base = op.join(cache_dir, get_filename(dwi_file))
+    return (base + '_track.json', base + '_tensors.npz',
+            base + '_fibers.npy')
+
+
+def save_track_cache(cache_dir, dwi_file, mask_file, params, ten, tracks,
+                     bbox):
+    """
+    Caches tensors and fibers along with a manifest of the inputs and options
+    they were computed from. The tensors are saved as compressed arrays of
+    their eigenvalues, eigenvectors and FA rather than a pickled TensorFit.
+    The manifest is written last, so an interrupted write is never reused.
+    """
+    manifest_file, tensors_file, fibers_file = track_cache_files(cache_dir,
+                                                                 dwi_file)
+    manifest = {'dwi': file_stamp(dwi_file), 'mask': file_stamp(mask_file),
+                'params': params}
+    try:
+        if not op.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        if op.isfile(manifest_file):
+            os.remove(manifest_file)
+        np.savez_compressed(tensors_file, evals=ten.evals, evecs=ten.evecs,
+                            fa=ten.fa,
+                            bbox=[[s.start, s.stop] for s in bbox])
+        tracks.save(fibers_file)
+        tmp = "{}.{}".format(manifest_file, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, manifest_file)
+    except (IOError, OSError) as e:
+        print("Could not cache tensors and fibers in {}: {}".format(cache_dir,
+                                                                   e))
+
+
+def load_track_cache(cache_dir, dwi_file, mask_file, gtab, params):
+    """
+    Loads cached tensors and fibers if they were computed from the same DWI
+    volume, mask and options (see save_track_cache). Returns the tensors,
+    fibers and bounding box of the tracked region, or None if there is no
+    matching cache.
+    """
+    manifest_file, tensors_file, fibers_file = track_cache_files(cache_dir,
+                                                                 dwi_file)
+    if not all(op.isfile(f) for f in (manifest_file, tensors_file,
+                                      fibers_file, offsets_file(fibers_file))):
+        return None
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    # Compare the options as they read back from json
+    if manifest['params'] != json.loads(json.dumps(params)) or \
+            not stamp_matches(dwi_file, manifest['dwi']) or \
+            not stamp_matches(mask_file, manifest['mask']):
+        return None
+
+    tensors = np.load(tensors_file)
+    evals = tensors['evals']
+    evecs = tensors['evecs'].reshape(evals.shape[:3] + (9,))
+    ten = TensorFit(TensorModel(gtab), np.concatenate([evals, evecs], -1))
+    bbox = tuple(slice(int(a), int(b)) for a, b in tensors['bbox'])
+    return ten, fiber_array.load(fibers_file), bbox
+
+
+def mask_bbox(mask, margin=0):
+    """
+    Returns the bounding box of the non-zero voxels of a mask, grown by
+    margin voxels on each side and clipped to the volume, as a tuple of
+    slices. An empty mask gives an empty box.
+
+    **Positional Arguments:**
+
+            mask:
+                - 3D volume
+
+    **Optional Arguments:**
+
+            margin:
+                - Number of voxels to pad the box by
+    """
+    nonzero = np.transpose(np.nonzero(mask))
+    if not len(nonzero):
+        return (slice(0, 0),) * 3
+    start = np.maximum(nonzero.min(axis=0) - margin, 0)
+    stop = np.minimum(nonzero.max(axis=0) + margin + 1, mask.shape[:3])
+    return tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+
+
+def seed_points(mask, fa=None, stride=1, density=1, fa_thresh=None,
+                max_seeds=None, rng_seed=42, origin=(0, 0, 0)):
+    """
+    Places tractography seeds in the non-zero voxels of a mask. With the
+    defaults there is one seed at the center of every voxel.
+
+    **Positional Arguments:**
+
+            mask:
+                - 3D volume whose non-zero voxels may be seeded
+
+    **Optional Arguments:**
+
+            fa:
+                - 3D anisotropy volume, required with fa_thresh
+            stride:
+                - Only seed voxels whose coordinates are all multiples of
+                  stride, e.g. 2 keeps one voxel in eight
+            density:
+                - Number of seeds per voxel. Above 1, the seeds are placed
+                  uniformly at random within each voxel
+            fa_thresh:
+                - Only seed voxels with FA above this value (white matter)
+            max_seeds:
+                - Total seed budget; larger seed sets are randomly subsampled
+            rng_seed:
+                - Seed of the random number generator, so that seeding is
+                  reproducible
+            origin:
+                - Position of mask within a larger volume, to which the
+                  stride grid is aligned, so that cropping does not change
+                  the voxels seeded
+    """
+    voxels = mask > 0
+    if fa_thresh is not None:
+        if fa is None:
+            raise ValueError("FA thresholded seeding requires an FA volume.")
+        voxels &= fa > fa_thresh
+    if stride > 1:
+        grid = np.zeros(voxels.shape, dtype=bool)
+        grid[tuple(slice(-o % stride, None, stride) for o in origin)] = True
+        voxels &= grid
+    seeds = np.transpose(np.where(voxels))
+
+    rng = np.random.RandomState(rng_seed)
+    if density > 1:
+        seeds = np.repeat(seeds, density, axis=0)
+        seeds = seeds + rng.uniform(-0.5, 0.5, seeds.shape)
+    if max_seeds is not None and len(seeds) > max_seeds:
+        keep = np.sort(rng.choice(len(seeds), max_seeds, replace=False))
+        seeds = seeds[keep]
+    return seeds
+
+
+# Approximate number of float64 copies of a DWI slab made during a fit
+FIT_OVERHEAD = 6
+
+
+def fit_tensors(data, mask, gtab, n_jobs=1, mem_budget=2048,
+                dtype=np.float64):
+    """
+    Fits the tensor model slab by slab along z, so the float64
+    intermediates of the fit only ever exist for a slab at a time. Slabs
+    are sized to fit the memory budget across all processes, and those
+    without any voxels in the mask are skipped. Returns the same fit as
+    fitting the whole volume at once.
+
+    **Positional Arguments:**
+
+            data:
+                - 4D DWI volume
+            mask:
+                - 3D brain mask
+            gtab:
+                - dipy formatted bval/bvec Structure
+
+    **Optional Arguments:**
+
+            n_jobs:
+                - Number of processes over which slabs are fit
+            mem_budget:
+                - Approximate memory, in MB, for the fit intermediates
+            dtype:
+                - Data type of the fitted tensor parameters
+    """
+    model = TensorModel(gtab)
+    params = np.zeros(data.shape[:3] + (12,), dtype=dtype)
+    if not np.any(mask):
+        return TensorFit(model, params)
+    nz = data.shape[2]
+    slice_bytes = 8 * FIT_OVERHEAD * data.shape[0] * data.shape[1] * \
+        data.shape[3]
+    thick = mem_budget * 2 ** 20 // (slice_bytes * max(n_jobs, 1))
+    thick = int(min(max(thick, 1), nz))
+
+    zs = [z for z in range(0, nz, thick) if np.any(mask[:, :, z:z + thick])]
+    slabs = ((model, data[:, :, z:z + thick], mask[:, :, z:z + thick])
+             for z in zs)
+    if n_jobs <= 1:
+        for z, slab in zip(zs, slabs):
+            params[:, :, z:z + thick] = _fit_slab(slab)
+        return TensorFit(model, params)
+
+    pool = Pool(n_jobs)
+    try:
+        for z, slab in zip(zs, pool.imap(_fit_slab, slabs)):
+            params[:, :, z:z + thick] = slab
+    finally:
+        pool.close()
+        pool.join()
+    return TensorFit(model, params)
+
+
+def _fit_slab(args):
+    """
+    Fits the tensor model to a slab of a DWI volume
+    """
+    model, data, mask = args
+    return model.fit(data, mask=mask).model_params
+
+
+def eudx_tracks(fa, ind, seeds, odf_vertices, stop_val, n_jobs=1):
+    """
+    Runs EuDX from each seed. With n_jobs > 1 the seeds are split into
+    contiguous partitions tracked by a pool of processes, which read the FA
+    and direction index volumes from memory-mapped temporary .npy files.
+    Partitions are merged in seed order, so the streamlines are identical
+    to, and in the same order as, those of a single process. The streamlines
+    are returned as a fiber_array.
+
+    **Positional Arguments:**
+
+            fa:
+                - 3D anisotropy volume used as the stopping criterion
+            ind:
+                - 3D volume of the indices of each voxel's direction on the
+                  sphere given by odf_vertices
+            seeds:
+                - (N, 3) array of seed points in voxel coordinates
+            odf_vertices:
+                - Vertices of the sphere
+            stop_val:
+                - Value to cutoff fiber track
+
+    **Optional Arguments:**
+
+            n_jobs:
+                - Number of processes used for tracking
+    """
+    if n_jobs <= 1:
+        eu = EuDX(a=fa, ind=ind, seeds=seeds, odf_vertices=odf_vertices,
+                  a_low=stop_val)
+        return fiber_array.from_iter(eu)
+
+    tmpdir = tempfile.mkdtemp(prefix='ndmg_track_')
+    fa_file = op.join(tmpdir, 'fa.npy')
+    ind_file = op.join(tmpdir, 'ind.npy')
+    np.save(fa_file, fa)
+    np.save(ind_file, ind)
+
+    chunks = [(fa_file, ind_file, chunk, odf_vertices, stop_val)
+              for chunk in np.array_split(seeds, 4 * n_jobs) if len(chunk)]
+    pool = Pool(n_jobs)
+    try:
+        parts = pool.map(_eudx_chunk, chunks)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(tmpdir)
+    return fiber_array.concatenate(parts)
+
+
+def _eudx_chunk(args):
+    """
+    Pool worker: runs EuDX from a partition of the seeds
+    """
+    fa_file, ind_file, seeds, odf_vertices, stop_val = args
+    eu = EuDX(a=np.load(fa_file, mmap_mode='r'),
+              ind=np.load(ind_file, mmap_mode='r'), seeds=seeds,
+              odf_vertices=odf_vertices, a_low=stop_val)
+    return fiber_array.from_iter(eu)
+
+
+def lockstep_tracks(fa, directions, seeds, stop_val, step_size=0.5,
+                    max_angle=60., max_steps=1000, chunk_size=100000):
+    """
+    Deterministic tracking which advances every streamline together: each
+    iteration interpolates the direction at all active points, steps them
+    and applies the stopping criteria as array operations. Streamlines are
+    tracked in both directions from each seed, and use the voxel coordinate
+    convention of EuDX, with voxel centers at integer coordinates. Seeds
+    from which only the seed point is tracked give no streamline. Returns a
+    fiber_array, in seed order.
+
+    **Positional Arguments:**
+
+            fa:
+                - 3D anisotropy volume used as the stopping criterion
+            directions:
+                - (X, Y, Z, 3) principal diffusion direction of each voxel,
+                  e.g. TensorFit.evecs[..., 0]
+            seeds:
+                - (N, 3) array of seed points in voxel coordinates
+            stop_val:
+                - Streamlines stop where the trilinearly interpolated FA
+                  falls below this value
+
+    **Optional Arguments:**
+
+            step_size:
+                - Length of each step, in voxels
+            max_angle:
+                - Streamlines stop rather than turn by more than this many
+                  degrees in one step
+            max_steps:
+                - Maximum number of steps in each direction from a seed
+            chunk_size:
+                - Number of seeds tracked together, to bound memory use
+    """
+    fa = np.asarray(fa, dtype=np.float64)
+    directions = np.asarray(directions, dtype=np.float64).reshape(-1, 3)
+    seeds = np.asarray(seeds, dtype=np.float64).reshape(-1, 3)
+    parts = []
+    for start in range(0, len(seeds), chunk_size):
+        parts += [_lockstep_chunk(fa, directions, seeds[start:start +
+                                                        chunk_size],
+                                  stop_val, step_size,
+                                  np.cos(np.deg2rad(max_angle)), max_steps)]
+    return fiber_array.concatenate(parts)
+
+
+def _lockstep_chunk(fa, directions, seeds, stop_val, step_size, min_cos,
+                    max_steps):
+    """
+    Tracks a chunk of seeds in lockstep (see lockstep_tracks)
+    """
+    shape = np.array(fa.shape)
+    fa_flat = fa.ravel()
+    nseeds = len(seeds)
+
+    # Each seed starts two half-streamlines, along and against the direction
+    # of its voxel; points are recorded with their seed and a step number
+    # which is negative for the backward half
+    voxel = np.clip(np.round(seeds).astype(np.intp), 0, shape - 1)
+    first = directions[np.ravel_multi_index(voxel.T, fa.shape)]
+    ok = _inside(seeds, shape)
+    ok[ok] = _interp(fa_flat, *_trilinear(seeds[ok], shape)) >= stop_val
+    ok &= np.any(first != 0, axis=1)
+    half = np.flatnonzero(np.concatenate([ok, ok]))
+    pos = np.concatenate([seeds, seeds])[half]
+    prev = np.concatenate([first, -first])[half]
+
+    rec_points = [seeds[ok]]
+    rec_seeds = [np.flatnonzero(ok)]
+    rec_steps = [np.zeros(ok.sum(), dtype=np.intp)]
+    for step in range(1, max_steps + 1):
+        if not len(pos):
+            break
+        corners, weights = _trilinear(pos, shape)
+        vecs = directions[corners]
+        # Align the corner directions with the direction of travel
+        sign = np.where(np.sum(vecs * prev, axis=-1) < 0, -1., 1.)
+        new_dir = np.sum((weights * sign)[..., np.newaxis] * vecs, axis=0)
+        norm = np.sqrt(np.sum(new_dir ** 2, axis=1))
+        ok = norm > 0
+        new_dir[ok] /= norm[ok, np.newaxis]
+        ok &= np.sum(new_dir * prev, axis=1) >= min_cos
+
+        new_pos = pos + step_size * new_dir
+        ok &= _inside(new_pos, shape)
+        ok[ok] = _interp(fa_flat, *_trilinear(new_pos[ok], shape)) >= \
+            stop_val
+        pos, prev, half = new_pos[ok], new_dir[ok], half[ok]
+
+        rec_points += [pos]
+        rec_seeds += [half % nseeds]
+        rec_steps += [np.where(half < nseeds, step, -step)]
+
+    seed_ids = np.concatenate(rec_seeds)
+    order = np.lexsort((np.concatenate(rec_steps), seed_ids))
+    points = np.concatenate(rec_points)[order]
+    seed_ids = seed_ids[order]
+    lengths = np.bincount(seed_ids, minlength=nseeds)
+    keep = lengths[seed_ids] > 1
+    return fiber_array(points[keep].astype(np.float32),
+                       lengths=lengths[lengths > 1])
+
+
+def _inside(points, shape):
+    """
+    Whether points lie within a volume of the given shape
+    """
+    return np.all((points >= -0.5) & (points < shape - 0.5), axis=1)
+
+
+def _trilinear(points, shape):
+    """
+    Returns the flat indices of the eight voxels around each point, clipped
+    to the volume, and their trilinear interpolation weights, as (8, M)
+    arrays
+    """
+    base = np.floor(points).astype(np.intp)
+    frac = points - base
+    corners = []
+    weights = []
+    for offset in np.ndindex(2, 2, 2):
+        offset = np.array(offset, dtype=bool)
+        idx = np.clip(base + offset, 0, shape - 1)
+        corners += [np.ravel_multi_index(idx.T, tuple(shape))]
+        weights += [np.prod(np.where(offset, frac, 1 - frac), axis=1)]
+    return np.array(corners), np.array(weights)
+
+
+def _interp(values, corners, weights):
+    """
+    Trilinearly interpolates a flattened volume (see _trilinear)
+    """
+    return np.sum(values[corners] * weights, axis=0)
@@ -24,6 +24,8 @@ from __future__ import print_function
 from collections import OrderedDict
 
 import networkx as nx
+import numpy as np
+import json
 import os
 
 
@@ -47,6 +49,9 @@ def loadGraphs(filenames, verb=False):
             print("Loading: " + files)
         #  Adds graphs to dictionary with key being filename
         fname = os.path.basename(files)
+        if files.endswith('.npz'):
+            gstruct[fname] = read_npz_graph(files)
+            continue
         try:
             gstruct[fname] = nx.read_weighted_edgelist(files) 
         except:
@@ -55,3 +60,31 @@ def loadGraphs(filenames, verb=False):
             except:
                 gstruct[fname] = nx.read_graphml(files)
     return gstruct
+
+
+def read_npz_graph(filename):
+    """
+    Reads a graph saved by ndmg's graph.save_graph in the npz format
+
+    Required parameters:
+        filename:
+            - Path to the .npz graph
+    """
+    npz = np.load(filename)
+    nnodes = len(npz['indptr']) - 1
+    row = np.repeat(np.arange(1, nnodes + 1), np.diff(npz['indptr']))
+    col = npz['indices'] + 1
+
+    g = nx.Graph(**json.loads(str(npz['attrs'])))
+    g.add_nodes_from(range(1, nnodes + 1))
+    attrs = [key for key in npz.files if key.startswith('attr_')]
+    if not attrs:
+        g.add_weighted_edges_from(zip(row.tolist(), col.tolist(),
+                                      npz['data'].tolist()))
+        return g
+
+    names = ['weight'] + [key[len('attr_'):] for key in attrs]
+    values = zip(*[npz[key].tolist() for key in ['data'] + attrs])
+    g.add_edges_from((u, v, dict(zip(names, val)))
+                     for u, v, val in zip(row.tolist(), col.tolist(), values))
+    return g
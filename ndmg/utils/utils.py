@@ -26,6 +26,9 @@ from dipy.core.gradients import gradient_table
 from subprocess import Popen, PIPE
 import numpy as np
 import nibabel as nb
+import hashlib
+import json
+import os
 import os.path as op
 import sys
 
@@ -47,16 +50,26 @@ def apply_mask(inp, masked, mask):
     pass
 
 
-def load_bval_bvec_dwi(fbval, fbvec, dwi_file, dwi_file_out):
+def load_bval_bvec_dwi(fbval, fbvec, dwi_file, dwi_file_out, dtype=None):
     """
     Takes bval and bvec files and produces a structure in dipy format
 
     **Positional Arguments:**
+
+    **Optional Arguments:**
+
+            dtype:
+                - Floating point type, e.g. np.float32, to narrow the DWI
+                  volume to and save it as if it is stored in a wider one
+                  (see narrow_dtype). By default the type on disk is kept.
     """
 
     # Load Data
     img = nb.load(dwi_file)
+    dtype = narrow_dtype(img.get_data_dtype(), dtype)
     data = img.get_data()
+    if dtype is not None:
+        data = np.asarray(data, dtype=dtype)
 
     bvals, bvecs = read_bvals_bvecs(fbval, fbvec)
 
@@ -70,6 +83,8 @@ def load_bval_bvec_dwi(fbval, fbvec, dwi_file, dwi_file_out):
     # Save corrected DTI volume
     dwi_new = nb.Nifti1Image(data, affine=img.get_affine(),
                              header=img.get_header())
+    if dtype is not None:
+        dwi_new.set_data_dtype(dtype)
     dwi_new.update_header()
     nb.save(dwi_new, dwi_file_out)
 
@@ -79,6 +94,25 @@ def load_bval_bvec_dwi(fbval, fbvec, dwi_file, dwi_file_out):
     return gtab
 
 
+def narrow_dtype(disk_dtype, dtype):
+    """
+    Returns dtype if it is narrower than the floating point type disk_dtype
+    of a volume, and None otherwise: integer volumes, and volumes already
+    stored as narrowly, are best kept in the type they are stored in.
+
+    **Positional Arguments:**
+        disk_dtype:
+            - the data type a volume is stored in.
+        dtype:
+            - the requested data type, or None.
+    """
+    if dtype is None or not np.issubdtype(disk_dtype, np.floating):
+        return None
+    if np.dtype(disk_dtype).itemsize <= np.dtype(dtype).itemsize:
+        return None
+    return dtype
+
+
 def load_bval_bvec(fbval, fbvec):
     """
     Takes bval and bvec files and produces a structure in dipy format
@@ -165,6 +199,267 @@ def get_braindata(brain_file):
     return braindata
 
 
+# Images loaded or saved this session, by absolute path, with the size and
+# mtime of the file they were read from or written to
+_IMAGES = {}
+
+
+def load_image(fname):
+    """
+    Loads a nifti image, with its data read into memory, through the image
+    registry: an image loaded or saved (see save_image) earlier in the
+    session is handed back from memory, as long as its file is unchanged,
+    so pipeline stages sharing an image decompress it only once. Meant for
+    3D images, such as atlases and masks, rather than 4D stacks, which stay
+    in memory until clear_images is called. The data is shared between
+    stages and must not be modified in place.
+
+    **Positional Arguments:**
+        fname:
+            - the path to the nifti image.
+    """
+    key = op.abspath(fname)
+    stat = os.stat(fname)
+    entry = _IMAGES.get(key)
+    if entry is not None and entry[0] == (stat.st_size, stat.st_mtime):
+        return entry[1]
+    img = nb.load(fname)
+    img.get_data()  # read once; later get_data calls return this array
+    _IMAGES[key] = ((stat.st_size, stat.st_mtime), img)
+    return img
+
+
+def save_image(img, fname):
+    """
+    Saves a nifti image and adds it to the image registry, so that stages
+    loading it with load_image use the image in memory rather than reading
+    it back from disk.
+
+    **Positional Arguments:**
+        img:
+            - the nibabel image to save.
+        fname:
+            - the path to save it to.
+    """
+    nb.save(img, fname)
+    stat = os.stat(fname)
+    _IMAGES[op.abspath(fname)] = ((stat.st_size, stat.st_mtime), img)
+
+
+def clear_images():
+    """
+    Drops all images from the image registry
+    """
+    _IMAGES.clear()
+
+
+# md5 hashes of the files hashed this session, by path, size and mtime
+_HASHES = {}
+
+
+def file_hash(fname, blocksize=2**20):
+    """
+    Computes the md5 hash of a file's contents, reading it in blocks. The
+    hash is remembered for as long as the file is unchanged (by size and
+    mtime), so each file is only read once per session.
+
+    **Positional Arguments:**
+        fname:
+            - the path to the file to hash.
+    """
+    stat = os.stat(fname)
+    key = (op.abspath(fname), stat.st_size, stat.st_mtime)
+    if key not in _HASHES:
+        md5 = hashlib.md5()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                md5.update(block)
+        _HASHES[key] = md5.hexdigest()
+    return _HASHES[key]
+
+
+def file_stamp(fname):
+    """
+    Returns the size, modification time and md5 hash of a file, by which
+    stamp_matches can later tell whether it has changed.
+
+    **Positional Arguments:**
+        fname:
+            - the path to the file to stamp.
+    """
+    stat = os.stat(fname)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'md5': file_hash(fname)}
+
+
+def stamp_matches(fname, stamp):
+    """
+    Whether a file is unchanged since stamp (see file_stamp) was taken,
+    judged by size and mtime, falling back to the file hash so copied or
+    regenerated files with the same contents still match.
+
+    **Positional Arguments:**
+        fname:
+            - the path to the file to check.
+        stamp:
+            - dictionary holding the 'size', 'mtime' and 'md5' of the file.
+    """
+    stat = os.stat(fname)
+    if (stamp['size'], stamp['mtime']) == (stat.st_size, stat.st_mtime):
+        return True
+    return stamp['size'] == stat.st_size and stamp['md5'] == file_hash(fname)
+
+
+def atlas_index_dir(label_file):
+    """
+    Default location of the index for a label file: an index/ directory next
+    to it.
+    """
+    return op.join(op.dirname(op.abspath(label_file)), 'index')
+
+
+def atlas_index_name(label_file):
+    """
+    Name of the index of a label file: its file name and the hash of its
+    absolute path, so same-named parcellations from different directories
+    sharing an index directory don't overwrite each other.
+    """
+    path = op.abspath(label_file).encode('utf-8')
+    return "{}_{}".format(get_filename(label_file),
+                          hashlib.md5(path).hexdigest()[:12])
+
+
+def build_atlas_index(label_file, index_dir=None):
+    """
+    Builds an index for a parcellation so that it needn't be decompressed and
+    sorted each time it is used. The index is a compact uint16 (or uint32)
+    copy of the label volume saved as .npy so it can be memory-mapped, and a
+    .json manifest holding the sorted label table, voxel count of each label,
+    number of nodes, bounding box, affine, and the stamp of the source file.
+    The .npy is named after the hash of the label file's contents, and the
+    manifest names its .npy, so that a manifest is never paired with the
+    label volume of another version of the file.
+
+    **Positional Arguments:**
+        label_file:
+            - the path to a nifti label volume.
+
+    **Optional Arguments:**
+        index_dir:
+            - the directory in which to store the index. Defaults to
+            atlas_index_dir(label_file).
+
+    **Returns:**
+        index:
+            - dictionary of the index contents (see load_atlas_index). The
+            index is returned from memory if it cannot be written to disk.
+    """
+    if index_dir is None:
+        index_dir = atlas_index_dir(label_file)
+    name = atlas_index_name(label_file)
+
+    im = nb.load(label_file)
+    data = np.asarray(im.get_data())
+    ids, counts = np.unique(data, return_counts=True)
+    counts = counts[ids != 0]
+    ids = ids[ids != 0].astype(int)
+    big = len(ids) and ids.max() > np.iinfo(np.uint16).max
+    labels = data.astype(np.uint32 if big else np.uint16)
+
+    nz = np.transpose(np.nonzero(labels))
+    bbox = [nz.min(0).tolist(), (nz.max(0) + 1).tolist()] if len(nz) else \
+        [[0, 0, 0], list(labels.shape)]
+    stat = os.stat(label_file)
+    md5 = file_hash(label_file)
+    labels_file = op.join(index_dir, "{}_{}.npy".format(name, md5[:12]))
+    manifest = {'source': op.abspath(label_file),
+                'volume': op.basename(labels_file),
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'md5': md5,
+                'shape': list(labels.shape),
+                'N': len(ids),
+                'ids': ids.tolist(),
+                'counts': counts.tolist(),
+                'bbox': bbox,
+                'affine': im.get_affine().tolist()}
+
+    try:
+        if not op.isdir(index_dir):
+            os.makedirs(index_dir)
+        # Write then rename, so concurrent sessions never see partial files
+        tmp = "{}.{}".format(labels_file, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, labels)
+        os.rename(tmp, labels_file)
+        tmp = "{}.{}".format(op.join(index_dir, name + '.json'), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.rename(tmp, op.join(index_dir, name + '.json'))
+    except (IOError, OSError) as e:
+        print("Could not write atlas index to {}: {}".format(index_dir, e))
+        return _atlas_index(manifest, labels, None)
+    return _atlas_index(manifest, np.load(labels_file, mmap_mode='r'),
+                        labels_file)
+
+
+def load_atlas_index(label_file, index_dir=None):
+    """
+    Loads the index of a parcellation, building it if it doesn't exist, was
+    built from another file, or if the label file has changed since it was
+    built (by size and mtime, falling back to the file hash so touched
+    atlases don't trigger a rebuild).
+
+    **Positional Arguments:**
+        label_file:
+            - the path to a nifti label volume.
+
+    **Optional Arguments:**
+        index_dir:
+            - the directory in which the index is stored. Defaults to
+            atlas_index_dir(label_file).
+
+    **Returns:**
+        index:
+            - dictionary with keys 'labels' (memory-mapped label volume),
+            'labels_file' (path of the .npy), 'ids' (sorted nonzero labels),
+            'counts' (voxels per label), 'N', 'shape', 'bbox' ([min, max)
+            voxel corners of the labelled region) and 'affine'.
+    """
+    if index_dir is None:
+        index_dir = atlas_index_dir(label_file)
+    manifest_file = op.join(index_dir, atlas_index_name(label_file) + '.json')
+
+    if not op.isfile(manifest_file):
+        return build_atlas_index(label_file, index_dir)
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+
+    labels_file = op.join(index_dir, manifest.get('volume', ''))
+    if (manifest.get('source') != op.abspath(label_file) or
+            not op.isfile(labels_file) or
+            not stamp_matches(label_file, manifest)):
+        return build_atlas_index(label_file, index_dir)
+    labels = np.load(labels_file, mmap_mode='r')
+    if list(labels.shape) != manifest['shape']:
+        return build_atlas_index(label_file, index_dir)
+    return _atlas_index(manifest, labels, labels_file)
+
+
+def _atlas_index(manifest, labels, labels_file):
+    """
+    Packs the contents of an atlas index into a dictionary
+    """
+    index = dict(manifest)
+    index['labels'] = labels
+    index['labels_file'] = labels_file
+    index['ids'] = np.array(manifest['ids'], dtype=labels.dtype)
+    index['counts'] = np.array(manifest['counts'])
+    index['shape'] = tuple(manifest['shape'])
+    index['affine'] = np.array(manifest['affine'])
+    return index
+
+
 def extract_brain(inp, out, opts=""):
     """
     A function to extract the brain from an image using FSL's BET.
@@ -176,7 +471,27 @@ def extract_brain(inp, out, opts=""):
             - the output brain extracted image.
     """
     cmd = "bet {} {} {}".format(inp, out, opts)
-    execute_cmd(cmd)
+    execute_cmd(fsl_cmd(cmd, out))
+
+
+def fsl_cmd(cmd, out):
+    """
+    Prefixes an FSL command with the FSLOUTPUTTYPE matching the extension
+    of its output image, as FSL otherwise writes images of the type set in
+    the environment whatever extension they are given. Temporary images
+    can then be named .nii, so they are written and read back without gzip.
+
+    **Positional Arguments:**
+        cmd:
+            - the FSL command.
+        out:
+            - the path of the image it writes.
+    """
+    if out.endswith('.nii'):
+        return "FSLOUTPUTTYPE=NIFTI " + cmd
+    if out.endswith('.nii.gz'):
+        return "FSLOUTPUTTYPE=NIFTI_GZ " + cmd
+    return cmd
 
 
 def execute_cmd(cmd, verb=False):
@@ -187,7 +502,9 @@ def execute_cmd(cmd, verb=False):
     if verb:
         print("Executing: {}".format(cmd))
 
-    p = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True)
+    # Commands may run concurrently from several threads, so children must
+    # not inherit each other's pipes (the default on Python 2)
+    p = Popen(cmd, stdout=PIPE, stderr=PIPE, shell=True, close_fds=True)
     out, err = p.communicate()
     code = p.returncode
     if code: